@@ -0,0 +1,68 @@
+"""
+Eager against compiled latency of the video generation path, on the CPU with the tiny models of
+config/tiny_cpu.yaml. Each run is a scenario of `sequence_benchmark.py` in a fresh process:
+
+    eager          the models as loaded
+    compiled_cold  compile.enabled with an empty compilation cache
+    compiled_warm  compile.enabled again, with the cache the cold run left behind
+
+The initial frame and the first batch of subsequent frames include the compilation of their
+shapes, which the warm run mostly reads from the cache. The frame latency is the median over the
+frames after them, where eager and compiled run the same static shapes.
+
+    python benchmarks/compile_benchmark.py
+    python benchmarks/compile_benchmark.py --batch-size 2 --mode max-autotune
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from sequence_benchmark import run_scenario
+
+COLUMNS = ("initial_ms", "warmup_ms", "frame_ms", "frames_per_s")
+
+
+def run(overrides, args):
+    # a fresh process per run, so nothing compiled or cached in memory carries over
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_scenario, "default", args.frames, args.threads, args.size, args.steps,
+                           overrides).result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare eager and compiled per-frame latency on the CPU.")
+    parser.add_argument('--frames', type=int, default=8, help="Subsequent frames per run.")
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 144], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--backend', default="inductor")
+    parser.add_argument('--mode', default=None, help="torch.compile mode, e.g. max-autotune.")
+    args = parser.parse_args()
+    # the first batch of subsequent frames is the warm-up, at least one frame has to follow it
+    if args.frames <= args.batch_size:
+        parser.error(f"--frames must exceed --batch-size ({args.batch_size}), the first batch is the warm-up "
+                     "and no frame would be measured")
+
+    generation = {"batch_size": args.batch_size}
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        compiled = {"enabled": True, "backend": args.backend, "mode": args.mode, "cache_dir": cache_dir}
+        try:
+            results["eager"] = run({"generation": generation}, args)
+            results["compiled_cold"] = run({"generation": generation, "compile": compiled}, args)
+            results["compiled_warm"] = run({"generation": generation, "compile": compiled}, args)
+        except ValueError as error:
+            print(f"{error}")
+            sys.exit(1)
+
+    print(f"{'run':<16}" + "".join(f"{column:>14}" for column in COLUMNS))
+    for name, metrics in results.items():
+        print(f"{name:<16}" + "".join(f"{metrics[column]:>14.1f}" for column in COLUMNS))
+    eager, warm = results["eager"], results["compiled_warm"]
+    print(f"compiled frames: {eager['frame_ms'] / warm['frame_ms']:.2f}x the eager speed, "
+          f"warm cache: {results['compiled_cold']['initial_ms'] / warm['initial_ms']:.2f}x faster initial frame")
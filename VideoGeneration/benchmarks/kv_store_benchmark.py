@@ -0,0 +1,99 @@
+"""
+Per-frame latency of the anchor-frame KV cache placements.
+
+Replays the "replace" traffic of one subsequent frame: for every denoising step each attn1 layer
+reads its cached keys and values, concatenates them with its own and runs attention. The layer
+layout follows the SDXL UNet at the given resolution.
+
+    python benchmarks/kv_store_benchmark.py --resolution 1024 --steps 50
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.kv_store import KV_STORES, get_kv_store  # noqa: E402
+
+# (number of attn1 layers, latent downsampling, inner dim, heads) of the SDXL UNet
+SDXL_ATTN1_LAYERS = [
+    (4, 2, 640, 10),  # down_blocks.1
+    (20, 4, 1280, 20),  # down_blocks.2
+    (10, 4, 1280, 20),  # mid_block
+    (30, 4, 1280, 20),  # up_blocks.0
+    (6, 2, 640, 10),  # up_blocks.1
+]
+
+
+def layer_shapes(resolution, batch_size=2):
+    latent = resolution // 8
+    shapes = []
+    for count, down, dim, heads in SDXL_ATTN1_LAYERS:
+        length = (latent // down) ** 2
+        shapes += [(batch_size, heads, length, dim // heads)] * count
+    return shapes
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def run_frame(store, shapes, steps, device, dtype, alpha=0.9):
+    index = 0
+    for _ in range(steps):
+        for shape in shapes:
+            query = torch.randn(shape, device=device, dtype=dtype)
+            key, value = store.get(("layer", index), device)
+            key = torch.cat((alpha * query, key), dim=2)
+            value = torch.cat((query, value), dim=2)
+            torch.nn.functional.scaled_dot_product_attention(query, key, value)
+            index += 1
+
+
+def benchmark(placement, shapes, steps, device, dtype, repeats):
+    store = get_kv_store(placement)
+    index = 0
+    for _ in range(steps):
+        for shape in shapes:
+            key = torch.randn(shape, device=device, dtype=dtype)
+            store.put(("layer", index), (key, key.clone()))
+            index += 1
+    synchronize(device)
+
+    run_frame(store, shapes, 1, device, dtype)
+    timings = []
+    for _ in range(repeats):
+        synchronize(device)
+        start = time.perf_counter()
+        run_frame(store, shapes, steps, device, dtype)
+        synchronize(device)
+        timings.append(time.perf_counter() - start)
+    nbytes = store.nbytes
+    store.clear()
+    return min(timings), nbytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the anchor-frame KV cache placements.")
+    parser.add_argument('--resolution', type=int, default=512)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--device', default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--placements', nargs="+", default=["cpu", "pinned", "device", "disk"],
+                        choices=sorted(KV_STORES))
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    shapes = layer_shapes(args.resolution)
+
+    print(f"{len(shapes)} attn1 layers x {args.steps} steps at {args.resolution}px on {device}")
+    results = {p: benchmark(p, shapes, args.steps, device, dtype, args.repeats) for p in args.placements}
+    baseline = results["cpu"][0] if "cpu" in results else None
+    print(f"{'placement':<10}{'frame (ms)':>12}{'saved (ms)':>12}{'cache (MB)':>12}")
+    for placement, (seconds, nbytes) in results.items():
+        saved = f"{(baseline - seconds) * 1000:.1f}" if baseline is not None else "-"
+        print(f"{placement:<10}{seconds * 1000:>12.1f}{saved:>12}{nbytes / 2 ** 20:>12.1f}")
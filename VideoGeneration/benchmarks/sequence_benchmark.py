@@ -0,0 +1,180 @@
+"""
+CPU benchmark of the video generation path with tiny randomly initialized SDXL-shaped models.
+
+Every scenario runs in a fresh process the same work as `generate_video_sequence` over the first
+frames of the bundled basketball conditions: the initial frame in "keep" mode, then the
+subsequent frames in "replace" mode through the output stage. It measures the latency of the
+initial frame and of the first (warm-up) batch, the median latency per subsequent frame, the
+throughput, the peak RSS of the process and the size of the anchor cache, and compares them with
+the stored baselines.
+
+    python benchmarks/sequence_benchmark.py
+    python benchmarks/sequence_benchmark.py --scenarios default batch2 --update
+
+The process exits with status 1 when a metric regresses past its threshold. Timings depend on
+the machine, record the baselines again with --update when moving to another one.
+"""
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, "benchmarks", "baselines.json")
+
+# overrides of config/tiny_cpu.yaml per scenario
+SCENARIOS = {
+    "default": {},
+    "batch2": {"generation": {"batch_size": 2}},
+    "fewer_steps": {"generation": {"subsequent_steps": 2}},
+    "device_int8": {"kv_cache": {"placement": "device", "dtype": "int8"}},
+    "mid_block": {"kv_cache": {"blocks": ["mid_block"]}},
+    "half_guidance": {"scale": {"guidance_end": 0.5}, "kv_cache": {"share_guidance": True}},
+    "chunked": {"kv_cache": {"chunk_size": 256}},
+}
+
+# metric: (direction, relative threshold); "lower" metrics regress when they grow
+METRICS = {
+    "initial_ms": ("lower", 0.25),
+    "warmup_ms": ("lower", 0.25),
+    "frame_ms": ("lower", 0.25),
+    "frames_per_s": ("higher", 0.2),
+    "peak_rss_mb": ("lower", 0.15),
+    "cache_mb": ("lower", 0.02),
+}
+
+
+def merge(config, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            merge(config.setdefault(key, {}), value)
+        else:
+            config[key] = value
+    return config
+
+
+def scenario_batch_size(overrides):
+    import yaml
+    with open(os.path.join(ROOT, "config", "tiny_cpu.yaml")) as file:
+        config = merge(yaml.safe_load(file), copy.deepcopy(overrides))
+    return config.get("generation", {}).get("batch_size", 1)
+
+
+def run_scenario(name, frames, threads, size, steps, overrides=None):
+    import torch
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import main
+    from utils.async_io import AsyncFrameWriter
+
+    torch.set_num_threads(threads)
+    config = merge(copy.deepcopy(main.load_config(os.path.join(ROOT, "config", "tiny_cpu.yaml"))), {
+        "system": {"device": "cpu"},
+        "generation": {"size": size, "num_inference_steps": steps},
+        "cache": {"anchor_dir": None},
+        "sharding": {"devices": []},
+    })
+    merge(config, copy.deepcopy(SCENARIOS[name] if overrides is None else overrides))
+    with tempfile.TemporaryDirectory() as output:
+        config["folders"]["output"]["base"] = output
+        main.load_pipeline(config, "cpu")
+        main.setup_job(config)
+        main.depth, main.canny_images = main.depth[:frames + 1], main.canny_images[:frames + 1]
+        batch_size = config["generation"].get("batch_size", 1)
+
+        with AsyncFrameWriter(main.output_dir, **main.io_config) as writer:
+            start = time.perf_counter()
+            main.get_initial_frame(0, output=writer)
+            initial = time.perf_counter() - start
+
+            # one warm-up batch, then the measured ones
+            start = time.perf_counter()
+            main.get_subsequent_frames(list(range(1, 1 + batch_size)), output=writer)
+            warmup = time.perf_counter() - start
+            indices = list(range(1 + batch_size, frames + 1))
+            per_frame = []
+            start = time.perf_counter()
+            for i in range(0, len(indices), batch_size):
+                batch = indices[i:i + batch_size]
+                batch_start = time.perf_counter()
+                main.get_subsequent_frames(batch, output=writer)
+                per_frame += [(time.perf_counter() - batch_start) / len(batch)] * len(batch)
+            total = time.perf_counter() - start
+
+    per_frame.sort()
+    return {
+        "initial_ms": initial * 1000,
+        "warmup_ms": warmup * 1000,
+        "frame_ms": per_frame[len(per_frame) // 2] * 1000,
+        "frames_per_s": len(indices) / total,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cache_mb": main.kv_store.nbytes / 2 ** 20,
+    }
+
+
+def compare(results, baselines, tolerance=1.0):
+    regressions = []
+    print(f"{'scenario':<14}{'metric':<14}{'value':>10}{'baseline':>10}{'change':>9}")
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            baseline = baselines.get(name, {}).get(metric)
+            if baseline is None:
+                print(f"{name:<14}{metric:<14}{value:>10.1f}{'-':>10}{'-':>9}")
+                continue
+            change = (value - baseline) / baseline if baseline else 0.0
+            direction, threshold = METRICS[metric]
+            regressed = change > threshold * tolerance if direction == "lower" else -change > threshold * tolerance
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{name:<14}{metric:<14}{value:>10.1f}{baseline:>10.1f}{change:>+9.0%}{flag}")
+            if regressed:
+                regressions.append(f"{name}/{metric}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the video generation path on the CPU with tiny models.")
+    parser.add_argument('--scenarios', nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--frames', type=int, default=8, help="Subsequent frames per scenario.")
+    parser.add_argument('--threads', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--size', type=int, nargs=2, default=[256, 144], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument('--steps', type=int, default=4)
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--tolerance', type=float, default=1.0, help="Multiplies every regression threshold.")
+    parser.add_argument('--update', action='store_true', help="Store the results as the new baselines.")
+    args = parser.parse_args()
+    # the first batch of subsequent frames is the warm-up, at least one frame has to follow it
+    batch_sizes = {name: scenario_batch_size(SCENARIOS[name]) for name in args.scenarios}
+    largest = max(batch_sizes, key=batch_sizes.get)
+    if args.frames <= batch_sizes[largest]:
+        parser.error(f"--frames must exceed the batch size of every scenario, the warm-up batch of {largest} "
+                     f"takes {batch_sizes[largest]} and no frame would be measured")
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name in args.scenarios:
+        # a fresh process per scenario, so the peak RSS and the allocator state are its own
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results[name] = pool.submit(run_scenario, name, args.frames, args.threads, args.size, args.steps).result()
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as file:
+            baselines = json.load(file)
+    regressions = compare(results, baselines, args.tolerance)
+
+    if args.update:
+        baselines.update({name: {metric: round(value, 3) for metric, value in metrics.items()}
+                          for name, metrics in results.items()})
+        with open(args.baselines, "w") as file:
+            json.dump(baselines, file, indent=2)
+        print(f"Baselines written to {args.baselines}")
+    elif regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
@@ -1,7 +1,25 @@
 import argparse
+import contextlib
+import copy
+import gc
+import json
 import os
-import imageio
+import tempfile
+import time
+import traceback
 import yaml
+import torch
+
+from utils.utils_all import *
+from utils.anchor_cache import AnchorCache, anchor_cache_key
+from utils.async_io import AsyncFrameWriter, save_png
+from utils.early_exit import AdaptiveScheduler, EarlyExit
+from utils.latent_decode import decode_latents
+from utils.video_writer import StreamingVideoWriter
+from utils.tracing import NullTracer, get_tracer, trace_pipeline
+
+tracer = NullTracer()
+PROMPT_SUFFIX = ', realism, High quality, 8K, Realistic image'
 
 
 def load_config(file_path):
@@ -9,130 +27,874 @@ def load_config(file_path):
         return yaml.safe_load(file)
 
 
-def get_initial_frame(idx, saved=True):
-    conds = [depth[idx], canny_images[idx]]
-    set_kv_to_none(pipe.unet)
-    image_0 = pipe(
-        prompt=prompt,
-        image=conds,
-        num_inference_steps=50,
-        latents=latent,
-        negative_prompt=negative_prompt,
-        controlnet_conditioning_scale=[depth_controlnet_scale, canny_controlnet_scale],
-        guidance_scale=guidance_scale,
-        cross_attention_kwargs={
-            "att_mode": "keep",
-            "alpha": alpha
-        },
-    ).images[0]
-    if saved:
+def merge_config(config, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            merge_config(config[key], value)
+        else:
+            config[key] = value
+    return config
+
+
+def save_frame(image, idx, output=None):
+    if output is not None:
+        output.save(image, f"{idx}.png")
+    else:
         os.makedirs(f"{output_dir}", exist_ok=True)
-        image_0.save(f"{output_dir}/{idx}.png")
-    return image_0
+        save_png(image, f"{output_dir}/{idx}.png")
 
 
-def get_subsequent_frame(idx, saved=True):
-    conds = [depth[idx], canny_images[idx]]
+def get_conds(indices):
+    if condition_cache is not None:
+        return condition_cache.batch(indices, device=pipe.device)
+    if len(indices) == 1:
+        return [depth[indices[0]], canny_images[indices[0]]]
+    # the pipeline only accepts a batch of conditions per ControlNet as a single tensor, which is
+    # resized to the output size here just as the pipeline resizes a single condition
+    return [
+        pipe.control_image_processor.preprocess([depth[i] for i in indices], height=height, width=width),
+        pipe.control_image_processor.preprocess([canny_images[i] for i in indices], height=height, width=width),
+    ]
 
-    move_index_to_zero(pipe.unet)
 
-    image = pipe(
-        prompt=prompt,
+def save_frames(indices, images, output=None):
+    # a batch holds the frames of every variant in turn, `output` is then one writer per variant
+    outputs = output if isinstance(output, list) else [output]
+    for i, image in enumerate(images):
+        save_frame(image, indices[i % len(indices)], outputs[i // len(indices)])
+
+
+def pipeline_inputs(indices, conds):
+    # the batch holds every variant in turn, each with its frames; the conditions are preprocessed
+    # once and shared by the variants. One generator per frame seeded from its index, so a frame
+    # is reproducible whichever process or batch renders it
+    embeds = [prompt_cache.get(variant['prompt'], negative_prompt, guidance_scale > 1, batch_size=len(indices))
+              for variant in variants]
+    if len(variants) > 1 and len(indices) > 1:
+        # a single condition is repeated over the batch by the pipeline itself
+        conds = [cond.repeat(len(variants), 1, 1, 1) for cond in conds]
+    return dict(
+        {key: torch.cat([embed[key] for embed in embeds]) for key in embeds[0]},
         image=conds,
-        num_inference_steps=50,
-        latents=latent,
-        negative_prompt=negative_prompt,
-        controlnet_conditioning_scale=[depth_controlnet_scale, canny_controlnet_scale],
-        guidance_scale=guidance_scale,
-        cross_attention_kwargs={
-            "att_mode": "replace",
-            "alpha": alpha
-        },
-    ).images[0]
+        latents=torch.cat([variant['latent'].repeat(len(indices), 1, 1, 1) for variant in variants]),
+        generator=[torch.Generator().manual_seed(variant['seed'] + idx) for variant in variants for idx in indices],
+    )
+
+
+def get_initial_frame(idx, saved=True, output=None):
+    return get_initial_frames(idx, saved, output)[0]
+
+
+def get_initial_frames(idx, saved=True, output=None):
+    # the initial frame of every variant, rendered in one batch
+    attention.reset()
+    attention.keep(alpha)
+    pipe.scheduler = anchor_scheduler
+    key = None
+    if anchor_cache is not None:
+        key = anchor_cache_key(anchor_settings, [depth[idx], canny_images[idx]])
+    if key is not None and key in anchor_cache:
+        with tracer.span("anchor_cache_load"):
+            image_0 = anchor_cache.load(key, kv_store, pipe.device)
+        if saved:
+            save_frame(image_0, idx, output)
+        return [image_0]
+
+    pipe.controlnet.reset(num_inference_steps)
+    guidance.reset(num_inference_steps, guidance_end, branches=2 if guidance_scale > 1 else 1)
+    with tracer.span("frame", "frame", frames=[idx], mode="keep"):
+        images = pipe(
+            **pipeline_inputs([idx], get_conds([idx])),
+            height=height,
+            width=width,
+            num_inference_steps=num_inference_steps,
+            controlnet_conditioning_scale=[depth_controlnet_scale, canny_controlnet_scale],
+            guidance_scale=guidance_scale,
+            output_type="pil" if decoder is None else "latent",
+        ).images
+    if controlnet_report:
+        print(pipe.controlnet.format_stats())
+    if decoder is not None:
+        decoder.add([idx], images)
+        images = [decoder.decode(flush=True)[idx]]
+    if key is not None:
+        with tracer.span("anchor_cache_save"):
+            anchor_cache.save(key, kv_store, images[0], anchor_settings)
     if saved:
+        save_frames([idx], images, output)
+    return images
+
+
+def get_subsequent_frames(indices, saved=True, output=None, decode=True):
+    # with several variants the images of each variant follow one another
+    with tracer.span("conditions", frames=list(indices)):
+        conds = get_conds(indices)
+
+    attention.replace(alpha)
+    pipe.scheduler = frame_scheduler
+    pipe.controlnet.reset(frame_steps)
+    guidance.reset(frame_steps, guidance_end, branches=2 if guidance_scale > 1 else 1)
+
+    with tracer.span("frame", "frame", frames=list(indices), mode="replace"):
+        try:
+            images = pipe(
+                **pipeline_inputs(indices, conds),
+                height=height,
+                width=width,
+                num_inference_steps=frame_steps,
+                controlnet_conditioning_scale=[depth_controlnet_scale, canny_controlnet_scale],
+                guidance_scale=guidance_scale,
+                output_type="pil" if decoder is None else "latent",
+            ).images
+        except EarlyExit as early_exit:
+            images = early_exit.latents if decoder is not None else decode_latents(pipe, early_exit.latents)
+    if steps_used is not None:
+        steps_used.update(dict.fromkeys(indices, frame_scheduler.steps))
+        print(f"frames {list(indices)}: {frame_scheduler.steps}/{frame_scheduler.total_steps} steps")
+    if controlnet_report:
+        print(pipe.controlnet.format_stats())
+    if decoder is not None:
+        decoder.add(indices, images)
+        if not decode:
+            # the latents wait in the decoder queue, see render_deferred
+            return None
+        decoded = decoder.decode(flush=True)
+        images = [decoded[idx] for idx in indices]
+    if saved:
+        save_frames(indices, images, output)
+    return images
+
+
+def get_subsequent_frame(idx, saved=True, output=None):
+    return get_subsequent_frames([idx], saved=saved, output=output)[0]
+
+
+def pending_frames(start_idx=0, resume=False):
+    pending = [i for i in range(start_idx + 1, len(depth))
+               if not (resume and os.path.exists(f"{output_dir}/{i}.png"))]
+    if resume:
+        print(f"Resuming: {len(depth) - start_idx - 1 - len(pending)} frames already rendered, {len(pending)} to go")
+    return pending
+
+
+def generate_video_sequence(start_idx=0, batch_size=1, resume=False):
+    if keyframe_interval > 1:
+        return generate_keyframe_sequence(start_idx, batch_size, resume)
+    if len(variants) > 1:
+        return generate_variant_sequences(start_idx, batch_size, resume)
+    pending = pending_frames(start_idx, resume)
+
+    os.makedirs(f"{output_dir}", exist_ok=True)
+    video_path = f"{output_dir}/video.mkv" if movie_lossless else f"{output_dir}/video.mp4"
+    video = StreamingVideoWriter(video_path, fps=movie_fps, lossless=movie_lossless)
+    with AsyncFrameWriter(output_dir, video, tracer=tracer, **io_config) as output:
+        if resume and not pending and os.path.exists(f"{output_dir}/{start_idx}.png"):
+            output.append_video(f"{output_dir}/{start_idx}.png")
+        else:
+            output.append_video(get_initial_frame(start_idx, output=output))
+            if kv_store.report is not None:
+                print(kv_store.format_report())
+
+        # frames are queued in order, at most one batch of rendered frames is held here (one decode
+        # batch with deferred decoding, for which frames are rendered ahead until it is full)
+        rendered = {}
+        position = 0
+        for i in range(start_idx + 1, len(depth)):
+            while i not in rendered and position < len(pending) and (pending[position] == i or defer_decode and i in decoder):
+                indices = pending[position:position + batch_size]
+                position += len(indices)
+                if defer_decode:
+                    rendered.update(render_deferred(indices, output, flush=position == len(pending)))
+                else:
+                    rendered.update(zip(indices, get_subsequent_frames(indices, output=output)))
+            if i in rendered:
+                output.append_video(rendered.pop(i))
+            else:
+                output.append_video(f"{output_dir}/{i}.png")
+    if kv_store.report is not None:
+        print(attention.format_stats())
+    if attention_profiler is not None:
+        print(attention_profiler.format_report(kv_store))
+    report_steps()
+
+
+def generate_variant_sequences(start_idx=0, batch_size=1, resume=False):
+    r"""
+      Renders the sequence once per entry of the `variants` config section, each with its own
+      prompt and seed, into its own folder and video. The variants are denoised together: every
+      pipeline call holds `batch_size` frames of each of them, and they share the conditions,
+      the prompt cache and the ControlNet inputs of those frames. Each variant attends to the
+      cached keys and values of its own initial frame.
+      """
+    pending = [i for i in range(start_idx + 1, len(depth))
+               if not (resume and all(os.path.exists(f"{variant['output_dir']}/{i}.png") for variant in variants))]
+    if resume:
+        print(f"Resuming: {len(depth) - start_idx - 1 - len(pending)} frames already rendered, {len(pending)} to go")
+
+    with contextlib.ExitStack() as stack:
+        outputs = []
+        for variant in variants:
+            os.makedirs(variant['output_dir'], exist_ok=True)
+            extension = "mkv" if movie_lossless else "mp4"
+            video = StreamingVideoWriter(f"{variant['output_dir']}/video.{extension}", fps=movie_fps,
+                                         lossless=movie_lossless)
+            outputs.append(stack.enter_context(AsyncFrameWriter(variant['output_dir'], video, tracer=tracer,
+                                                                **io_config)))
+        for output, image in zip(outputs, get_initial_frames(start_idx, output=outputs)):
+            output.append_video(image)
+        if kv_store.report is not None:
+            print(kv_store.format_report())
+
+        # at most one batch of rendered frames per variant is held here
+        rendered = {}
+        position = 0
+        for i in range(start_idx + 1, len(depth)):
+            if i not in rendered and position < len(pending) and pending[position] == i:
+                indices = pending[position:position + batch_size]
+                position += len(indices)
+                images = get_subsequent_frames(indices, output=outputs)
+                rendered.update((idx, images[n::len(indices)]) for n, idx in enumerate(indices))
+            frames = rendered.pop(i, None)
+            for n, (variant, output) in enumerate(zip(variants, outputs)):
+                output.append_video(frames[n] if frames else f"{variant['output_dir']}/{i}.png")
+    print(f"{len(variants)} variants rendered in {output_dir}")
+    if kv_store.report is not None:
+        print(attention.format_stats())
+    if attention_profiler is not None:
+        print(attention_profiler.format_report(kv_store))
+    report_steps()
+
+
+def keyframe_indices(start_idx=0):
+    # the last frame is always a keyframe, so every frame in between has two neighbours
+    keys = list(range(start_idx, len(depth), keyframe_interval))
+    if keys[-1] != len(depth) - 1:
+        keys.append(len(depth) - 1)
+    return keys
+
+
+def load_frame(idx):
+    with Image.open(f"{output_dir}/{idx}.png") as image:
+        return image.convert("RGB")
+
+
+def render_or_load(indices, batch_size=1, resume=False, output=None):
+    frames = {}
+    if resume:
+        frames = {i: load_frame(i) for i in indices if os.path.exists(f"{output_dir}/{i}.png")}
+    pending = [i for i in indices if i not in frames]
+    for i in range(0, len(pending), batch_size):
+        batch = pending[i:i + batch_size]
+        frames.update(zip(batch, get_subsequent_frames(batch, output=output)))
+    return frames
+
+
+def interpolate_frames(indices, previous_idx, previous, following_idx, following, output=None):
+    from utils.interpolation import interpolate_frame
+    frames, fallback = {}, []
+    for i in indices:
+        with tracer.span("interpolate", frames=[i]):
+            frame, confidence = interpolate_frame(
+                (previous, depth[previous_idx], canny_images[previous_idx]),
+                (following, depth[following_idx], canny_images[following_idx]),
+                (depth[i], canny_images[i]),
+                (i - previous_idx) / (following_idx - previous_idx),
+                tolerance=keyframe_tolerance,
+            )
+        if confidence < keyframe_confidence:
+            fallback.append(i)
+            continue
+        frames[i] = Image.fromarray(frame)
+        save_frame(frames[i], i, output)
+    return frames, fallback
+
+
+def generate_keyframe_sequence(start_idx=0, batch_size=1, resume=False):
+    keys = keyframe_indices(start_idx)
+    counts = {"keyframes": len(keys), "interpolated": 0, "fallback": 0}
+
+    os.makedirs(f"{output_dir}", exist_ok=True)
+    video_path = f"{output_dir}/video.mkv" if movie_lossless else f"{output_dir}/video.mp4"
+    video = StreamingVideoWriter(video_path, fps=movie_fps, lossless=movie_lossless)
+    with AsyncFrameWriter(output_dir, video, tracer=tracer, **io_config) as output:
+        previous_idx = start_idx
+        previous = get_initial_frame(start_idx, output=output)
+        output.append_video(previous)
+        if kv_store.report is not None:
+            print(kv_store.format_report())
+
+        # keyframes are diffused one batch at a time, then the frames in between are warped from
+        # them; at most one batch of keyframes is held here
+        for position in range(1, len(keys), batch_size):
+            batch = keys[position:position + batch_size]
+            keyframes = render_or_load(batch, batch_size, resume, output)
+            for key in batch:
+                between = list(range(previous_idx + 1, key))
+                frames = {}
+                if resume:
+                    frames = {i: f"{output_dir}/{i}.png" for i in between if os.path.exists(f"{output_dir}/{i}.png")}
+                interpolated, fallback = interpolate_frames([i for i in between if i not in frames],
+                                                            previous_idx, previous, key, keyframes[key], output)
+                frames.update(interpolated)
+                # frames the warps do not explain well enough are diffused after all
+                frames.update(render_or_load(fallback, batch_size, output=output))
+                counts["interpolated"] += len(interpolated)
+                counts["fallback"] += len(fallback)
+                for i in between:
+                    output.append_video(frames[i])
+                output.append_video(keyframes[key])
+                previous_idx, previous = key, keyframes[key]
+    print(f"{counts['keyframes']} keyframes, {counts['interpolated']} frames interpolated, "
+          f"{counts['fallback']} diffused because their warps were not trusted")
+    if kv_store.report is not None:
+        print(attention.format_stats())
+    if attention_profiler is not None:
+        print(attention_profiler.format_report(kv_store))
+    report_steps()
+
+
+def report_steps(suffix=None):
+    # denoising steps each subsequent frame took with early exit, as steps.json in the output folder
+    if not steps_used:
+        return
+    steps = list(steps_used.values())
+    print(f"early exit: {sum(steps) / len(steps):.1f} steps per frame on average (min {min(steps)}, "
+          f"max {max(steps)}) of {frame_scheduler.total_steps}")
+    name = "steps.json" if suffix is None else f"steps.{suffix}.json"
+    with open(f"{output_dir}/{name}", "w") as file:
+        json.dump({str(idx): count for idx, count in sorted(steps_used.items())}, file, indent=2)
+
+
+def render_deferred(indices, output=None, flush=False):
+    # renders the frames into the decoder queue, returns the frames it decoded meanwhile
+    get_subsequent_frames(indices, output=output, decode=False)
+    frames = decoder.decode(flush=flush)
+    for idx, image in frames.items():
+        save_frame(image, idx, output)
+    return frames
+
+
+def render_frames(indices, batch_size=1, output=None):
+    for i in range(0, len(indices), batch_size):
+        if defer_decode:
+            render_deferred(indices[i:i + batch_size], output, flush=i + batch_size >= len(indices))
+        else:
+            get_subsequent_frames(indices[i:i + batch_size], output=output)
+
+
+def decode_saved_latents():
+    # decodes the latents saved by an earlier run again, e.g. with another VAE, and rebuilds the video
+    from utils.latent_decode import load_latents
+    latents_dir = f"{output_dir}/latents"
+    indices = sorted(int(name[:-len(".pt")]) for name in os.listdir(latents_dir) if name.endswith(".pt"))
+    with AsyncFrameWriter(output_dir, tracer=tracer, **io_config) as output:
+        for i in range(0, len(indices), decode_batch_size):
+            batch = indices[i:i + decode_batch_size]
+            with tracer.span("decode", frames=batch):
+                images = decode_latents(pipe, torch.cat([load_latents(latents_dir, idx) for idx in batch]))
+            for idx, image in zip(batch, images):
+                save_frame(image, idx, output)
+    print(f"Decoded {len(indices)} frames from {latents_dir}")
+    merge_video()
+
+
+def merge_video(start_idx=0):
+    video_path = f"{output_dir}/video.mkv" if movie_lossless else f"{output_dir}/video.mp4"
+    video = StreamingVideoWriter(video_path, fps=movie_fps, lossless=movie_lossless)
+    with AsyncFrameWriter(output_dir, video, tracer=tracer, **io_config) as output:
+        for i in range(start_idx, len(depth)):
+            output.append_video(f"{output_dir}/{i}.png")
+
+
+def shard_worker(config, device, indices, start_idx=0, batch_size=1, threads=None):
+    if threads:
+        torch.set_num_threads(threads)
+    setup_tracing(config, device)
+    with tracer.span("load_pipeline"):
+        load_pipeline(config, device)
+    with tracer.span("setup_job"):
+        setup_job(config)
+    # loads the keys and values the coordinator left in the anchor cache
+    get_initial_frame(start_idx, saved=False)
+    with AsyncFrameWriter(output_dir, tracer=tracer, **io_config) as output:
+        render_frames(indices, batch_size, output)
+    report_steps(suffix=f"{device.replace(':', '')}.{os.getpid()}")
+    write_trace(config, suffix=f"{device.replace(':', '')}.{os.getpid()}")
+
+
+def generate_sharded_sequence(config, devices, start_idx=0, batch_size=1, resume=False, threads=None):
+    r"""
+      Renders the sequence over several devices. This process is the coordinator: it renders the
+      initial frame on `devices[0]` and stores its keys and values in the anchor cache. One worker
+      process per other device then loads the same pipeline and anchor, and renders a contiguous
+      range of the remaining frames while the coordinator renders the first range. Once every
+      worker has finished, the video is assembled from the PNGs in frame order.
+
+      The devices must be of one type, several "cuda:N" or repeated "cpu": the pipeline runs in
+      float16 on CUDA and float32 on the CPU, and the workers share the anchor of the
+      coordinator. The initial latent and the per-frame generators are seeded from the config,
+      so on devices of the same kind (and CPU groups with the same threads) each frame comes out
+      the same whichever process renders it.
+      """
+    global anchor_cache
+    if keyframe_interval > 1:
+        raise ValueError("keyframes.interval > 1 interpolates between frames in order and cannot be sharded, "
+                         "render on a single device")
+    if len(variants) > 1:
+        raise ValueError("variants are rendered together in one batch and cannot be sharded, "
+                         "render on a single device")
+    device_types = sorted({torch.device(device).type for device in devices})
+    if len(device_types) > 1:
+        raise ValueError(f"sharding.devices mixes device types ({', '.join(device_types)}), the pipeline "
+                         "runs in float16 on cuda and float32 on cpu, shard over devices of one type")
+    private_cache = None
+    if anchor_cache is None:
+        # the workers need the initial frame, pass it through a private anchor cache that is
+        # removed once they have exited; it sits next to the output rather than in a tmpfs /tmp
         os.makedirs(f"{output_dir}", exist_ok=True)
-        image.save(f"{output_dir}/{idx}.png")
-    return image
+        private_cache = tempfile.TemporaryDirectory(prefix=".anchor_cache_", dir=output_dir)
+        config = dict(config, cache=dict(config.get('cache') or {}, anchor_dir=private_cache.name))
+        anchor_cache = AnchorCache(private_cache.name)
 
+    try:
+        pending = pending_frames(start_idx, resume)
+        get_initial_frame(start_idx)
+        if kv_store.report is not None:
+            print(kv_store.format_report())
 
-def generate_video_sequence(start_idx=0):
-    results = []
-    images = get_initial_frame(start_idx)
-    results.append(images)
-    for i in range(start_idx + 1, len(depth)):
-        idx = i
-        move_index_to_zero(pipe.unet)
-        images = get_subsequent_frame(idx)
-        results.append(images)
-    imageio.mimsave(
-        f"{output_dir}/video.mp4",
-        results, fps=movie_fps)
+        shards = [pending[len(pending) * i // len(devices):len(pending) * (i + 1) // len(devices)]
+                  for i in range(len(devices))]
+        context = torch.multiprocessing.get_context('spawn')
+        workers = []
+        for device, shard in zip(devices[1:], shards[1:]):
+            if shard:
+                worker = context.Process(target=shard_worker,
+                                         args=(config, device, shard, start_idx, batch_size, threads))
+                worker.start()
+                workers.append((device, shard, worker))
+        print(f"Rendering {len(pending)} frames on {len(workers) + 1} devices: "
+              + ", ".join(f"{device} {len(shard)}" for device, shard in zip(devices, shards)))
 
+        with AsyncFrameWriter(output_dir, tracer=tracer, **io_config) as output:
+            render_frames(shards[0], batch_size, output)
+        if kv_store.report is not None:
+            print(attention.format_stats())
+        if attention_profiler is not None:
+            print(attention_profiler.format_report(kv_store))
+        report_steps()
 
-if __name__ == '__main__':
+        failed = []
+        for device, shard, worker in workers:
+            worker.join()
+            if worker.exitcode != 0:
+                failed.append(f"{device} (frames {shard[0]}-{shard[-1]}, exit code {worker.exitcode})")
+        if failed:
+            raise RuntimeError(f"Workers failed: {', '.join(failed)}. Rerun with resume to render the missing frames")
+        with tracer.span("merge_video"):
+            merge_video(start_idx)
+    finally:
+        if private_cache is not None:
+            anchor_cache = None
+            private_cache.cleanup()
 
-    parser = argparse.ArgumentParser(description="Load YAML configuration file.")
-    parser.add_argument('config_path', help="Path to the YAML configuration file.")
-    args = parser.parse_args()
-    config = load_config(args.config_path)
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(config['system']['gpu_id'])
-
-    from utils.utils_all import *
-    from diffusers import (
-        StableDiffusionXLControlNetPipeline,
-        ControlNetModel,
-        AutoencoderKL,
-        DDIMScheduler
-    )
-    from diffusers.models import UNet2DConditionModel
-    import torch
-    from pytorch_lightning import seed_everything
-    seed_everything(config['system']['seed'])
 
-    canny_images = get_freestyle_images(f"{config['folders']['data']}/freestyle/")
-    depth = get_depth_images(f"{config['folders']['data']}/depth/")
+SCHEDULERS = {
+    'ddim': 'DDIMScheduler',
+    'dpm_solver': 'DPMSolverMultistepScheduler',
+    'euler': 'EulerDiscreteScheduler',
+    'unipc': 'UniPCMultistepScheduler',
+}
 
-    prompt = config['prompt'] + ', realism, High quality, 8K, Realistic image'
-    negative_prompt = "cartoon, anime, 3d, painting, monochrome, lowers, bad anatomy, worst quality, low quality"
 
-    controlnets = [
-        ControlNetModel.from_pretrained(
-            config['model']['controlnet']['depth'],
-            torch_dtype=torch.float16
-        ),
-        ControlNetModel.from_pretrained(
-            config['model']['controlnet']['canny'],
-            torch_dtype=torch.float16
-        ),
-    ]
-    vae = AutoencoderKL.from_pretrained(config['model']['vae'], torch_dtype=torch.float16)
+def get_scheduler(name, base_scheduler):
+    if name is None:
+        return base_scheduler
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler '{name}', expected one of {sorted(SCHEDULERS)}")
+    import diffusers
+    return getattr(diffusers, SCHEDULERS[name]).from_config(base_scheduler.config)
+
+
+def setup_tracing(config, device='cuda'):
+    global tracer
+    tracing_config = config.get('tracing', {})
+    tracer = get_tracer(tracing_config.get('enabled', False), device, tracing_config.get('synchronize', True))
+    return tracer
+
+
+def write_trace(config, suffix=None):
+    if not tracer.enabled:
+        return
+    path = config.get('tracing', {}).get('path') or f"{output_dir}/trace.json"
+    if suffix is not None:
+        root, ext = os.path.splitext(path)
+        path = f"{root}.{suffix}{ext}"
+    tracer.write(path)
+    print(tracer.format_summary())
+    print(f"Trace written to {path}")
+
+
+def load_pipeline(config, device='cuda'):
+    global pipe, kv_store, attention, guidance, prompt_cache, controlnet_report, anchor_scheduler, attention_profiler
+    from diffusers import StableDiffusionXLControlNetPipeline, DDIMScheduler
+    from utils.controlnet_schedule import ScheduledMultiControlNet
+    from utils.Cross_Frame_Attention import Cross_Frame_Attention
+    from utils.guidance import GuidanceTruncation
+    from utils.prompt_cache import PromptEmbeddingCache
+
+    # half precision convolutions are not implemented on the CPU
+    dtype = torch.float16 if torch.device(device).type == 'cuda' else torch.float32
+    snapshot = config['model'].get('snapshot')
+    tiny = config['model'].get('tiny', False)
+    pipeline_options = {}
+    if snapshot:
+        from utils.snapshot import load_snapshot
+        components, pipeline_options = load_snapshot(snapshot, device, dtype)
+        controlnets = components.pop('controlnet')
+    elif tiny:
+        from utils.tiny_models import tiny_components
+        components = tiny_components(seed=config['system']['seed'])
+        controlnets = components.pop('controlnet')
+    else:
+        from diffusers import AutoencoderKL, ControlNetModel
+        from diffusers.models import UNet2DConditionModel
+        controlnets = [
+            ControlNetModel.from_pretrained(
+                config['model']['controlnet']['depth'],
+                torch_dtype=dtype
+            ),
+            ControlNetModel.from_pretrained(
+                config['model']['controlnet']['canny'],
+                torch_dtype=dtype
+            ),
+        ]
+    schedule_config = config.get('controlnet_schedule', {})
+    controlnet_report = schedule_config.get('report', False)
+    controlnets = ScheduledMultiControlNet(
+        controlnets,
+        [schedule_config.get('depth', {}), schedule_config.get('canny', {})],
+        names=['depth', 'canny'],
+        profile=controlnet_report,
+    )
     scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", clip_sample=False,
                               set_alpha_to_one=True, steps_offset=1)
-    if config['model']['unet']['is_local']:
-        unet = UNet2DConditionModel.from_pretrained(config['model']['unet']['path'],
-                                                torch_dtype=torch.float16)
+    anchor_scheduler = scheduler
+    if snapshot or tiny:
+        pipe = StableDiffusionXLControlNetPipeline(**components, scheduler=scheduler, controlnet=controlnets,
+                                                   **pipeline_options)
+        pipe.to(dtype=dtype)
     else:
-        unet = UNet2DConditionModel.from_pretrained(config['model']['unet']['path'], subfolder="unet", torch_dtype=torch.float16)
+        vae = AutoencoderKL.from_pretrained(config['model']['vae'], torch_dtype=dtype)
+        if config['model']['unet']['is_local']:
+            unet = UNet2DConditionModel.from_pretrained(config['model']['unet']['path'],
+                                                        torch_dtype=dtype)
+        else:
+            unet = UNet2DConditionModel.from_pretrained(config['model']['unet']['path'], subfolder="unet", torch_dtype=dtype)
 
-    pipe = StableDiffusionXLControlNetPipeline.from_pretrained(
-        config['model']['pipe'],
-        unet=unet, scheduler=scheduler, controlnet=controlnets, vae=vae, torch_dtype=torch.float16
-    )
+        pipe = StableDiffusionXLControlNetPipeline.from_pretrained(
+            config['model']['pipe'],
+            unet=unet, scheduler=scheduler, controlnet=controlnets, vae=vae, torch_dtype=dtype
+        )
 
-    from utils.Cross_Frame_Attention import Cross_Frame_Attention
-    register_attention_control(pipe, Cross_Frame_Attention)
+    kv_cache_config = config.get('kv_cache', {})
+    kv_store = get_kv_store(kv_cache_config.get('placement', 'cpu'),
+                            dtype=kv_cache_config.get('dtype'),
+                            report=kv_cache_config.get('report', False),
+                            **kv_cache_config.get('options', {}))
+    attention = register_attention_control(pipe, Cross_Frame_Attention, kv_store=kv_store,
+                                           blocks=kv_cache_config.get('blocks'),
+                                           timesteps=kv_cache_config.get('timesteps'))
+    attention.share_guidance = kv_cache_config.get('share_guidance', False)
+    attention.chunk_size = kv_cache_config.get('chunk_size')
+    guidance = GuidanceTruncation(attention).attach(pipe)
+    attention_profiler = None
+    if kv_cache_config.get('profile', False):
+        from utils.attention_profile import AttentionProfiler
+        attention_profiler = AttentionProfiler(pipe.unet, attention)
+    if tracer.enabled:
+        trace_pipeline(tracer, pipe)
+        if config.get('tracing', {}).get('kv', False):
+            attention.tracer = tracer
     # pipe.enable_model_cpu_offload()
-    pipe.to('cuda')
+    pipe.to(device)
+
+    compile_config = config.get('compile', {})
+    if compile_config.get('enabled', False):
+        if attention_profiler is not None or controlnet_report:
+            raise ValueError("kv_cache.profile and controlnet_schedule.report time single layers, which the "
+                             "compiled graphs fuse, disable them with compile.enabled")
+        from utils.compilation import compile_pipeline
+        compile_pipeline(pipe, attention, backend=compile_config.get('backend', 'inductor'),
+                         mode=compile_config.get('mode'), cache_dir=compile_config.get('cache_dir'))
+
+    prompt_cache_config = config.get('prompt_cache', {})
+    prompt_cache = PromptEmbeddingCache(pipe, maxsize=prompt_cache_config.get('size', 8),
+                                        offload_text_encoders=prompt_cache_config.get('offload_text_encoders', False))
+    return pipe
+
+
+def setup_job(config):
+    global depth, canny_images, condition_cache, prompt, negative_prompt, seed, latent, height, width
+    global movie_fps, movie_lossless, io_config, alpha, guidance_scale, depth_controlnet_scale, canny_controlnet_scale
+    global output_dir, num_inference_steps, frame_steps, frame_scheduler, anchor_cache, anchor_settings, guidance_end
+    global keyframe_interval, keyframe_confidence, keyframe_tolerance, decoder, defer_decode, decode_batch_size
+    global steps_used, variants
+    seed = config['system']['seed']
+    seed_everything(seed)
+
+    with tracer.span("load_conditions"):
+        depth, canny_images = get_condition_images(config['folders']['data'])
 
-    h, w = canny_images[0].size
-    h, w = h // pipe.vae_scale_factor, w // pipe.vae_scale_factor
-    latent = torch.randn((1, 4, w, h), dtype=torch.float16)
+    prompt = config['prompt'] + PROMPT_SUFFIX
+    negative_prompt = "cartoon, anime, 3d, painting, monochrome, lowers, bad anatomy, worst quality, low quality"
+
+    generation_config = config.get('generation', {})
+    width, height = generation_config.get('size') or canny_images.size
+    width, height = width - width % pipe.vae_scale_factor, height - height % pipe.vae_scale_factor
+    condition_cache = None
+    if config.get('conditions', {}).get('cache', False):
+        from utils.condition_cache import load_condition_cache
+        with tracer.span("load_conditions"):
+            # the cache holds the conditions at the output size, it is rebuilt when the size changes
+            condition_cache = load_condition_cache(config['folders']['data'], config['conditions'].get('cache_dir'),
+                                                   size=(width, height), vae_scale_factor=pipe.vae_scale_factor)
+    latent = torch.randn((1, 4, height // pipe.vae_scale_factor, width // pipe.vae_scale_factor),
+                         generator=torch.Generator().manual_seed(seed), dtype=pipe.unet.dtype)
     movie_fps = config['movie']['fps']
+    movie_lossless = config['movie'].get('lossless', False)
+    io_config = config.get('io', {})
     alpha = config['model']['alpha']
     guidance_scale = config['scale']['guidance']
+    # without guidance the pipeline runs a single branch, there is nothing to truncate
+    guidance_end = config['scale'].get('guidance_end', 1.0) if guidance_scale > 1 else 1.0
     depth_controlnet_scale = config['scale']['depth_controlnet']
     canny_controlnet_scale = config['scale']['canny_controlnet']
     output_dir = os.path.join(config['folders']['output']['base'], config['folders']['output']['sub_folder'])
-    generate_video_sequence()
 
+    # every variant renders into its own folder under the output folder, with its own initial latent
+    variants = [{'prompt': prompt, 'seed': seed, 'latent': latent, 'output_dir': output_dir}]
+    if config.get('variants'):
+        variants = []
+        for i, variant in enumerate(config['variants']):
+            variant_seed = variant.get('seed', seed)
+            variants.append({
+                'prompt': variant.get('prompt', config['prompt']) + PROMPT_SUFFIX,
+                'seed': variant_seed,
+                'latent': torch.randn(latent.shape, generator=torch.Generator().manual_seed(variant_seed),
+                                      dtype=latent.dtype),
+                'output_dir': os.path.join(output_dir, variant.get('name') or f"{i}_seed{variant_seed}"),
+            })
+        if len(variants) == 1:
+            # a single variant simply replaces the prompt, seed and output folder of the job
+            prompt, seed, latent, output_dir = (variants[0][key] for key in ('prompt', 'seed', 'latent', 'output_dir'))
+
+    num_inference_steps = generation_config.get('num_inference_steps', 50)
+    # subsequent frames read the cached keys and values of the nearest timestep of the initial frame
+    frame_steps = generation_config.get('subsequent_steps') or num_inference_steps
+    frame_scheduler = get_scheduler(generation_config.get('subsequent_scheduler'), anchor_scheduler)
+    early_exit_config = config.get('early_exit', {})
+    steps_used = None
+    if early_exit_config.get('enabled', False):
+        frame_scheduler = AdaptiveScheduler(frame_scheduler,
+                                            threshold=early_exit_config.get('threshold', 0.005),
+                                            metric=early_exit_config.get('metric', 'x0'),
+                                            min_fraction=early_exit_config.get('min_fraction', 0.3))
+        steps_used = {}
+
+    decode_config = config.get('decode', {})
+    defer_decode = decode_config.get('deferred', False)
+    decode_batch_size = decode_config.get('batch_size', 4)
+    decoder = None
+    if defer_decode or decode_config.get('save_latents', False):
+        from utils.latent_decode import LatentDecoder
+        decoder = LatentDecoder(pipe, decode_batch_size,
+                                f"{output_dir}/latents" if decode_config.get('save_latents', False) else None,
+                                tracer=tracer)
+    if decode_config.get('tiled', False):
+        pipe.vae.enable_tiling()
+    else:
+        pipe.vae.disable_tiling()
+
+    keyframe_config = config.get('keyframes', {})
+    keyframe_interval = keyframe_config.get('interval', 1)
+    keyframe_confidence = keyframe_config.get('min_confidence', 0.9)
+    keyframe_tolerance = keyframe_config.get('depth_tolerance', 0.03)
+
+    if len(variants) > 1 and (keyframe_interval > 1 or decoder is not None):
+        raise ValueError("variants are rendered with every frame diffused and decoded in its pipeline call, "
+                         "set keyframes.interval to 1 and disable decode.deferred and decode.save_latents")
+    attention.variants = len(variants)
+
+    cache_config = config.get('cache', {})
+    # an anchor cache entry holds a single initial frame, variants always render theirs together
+    anchor_cache = None
+    if cache_config.get('anchor_dir') and len(variants) == 1:
+        anchor_cache = AnchorCache(cache_config['anchor_dir'])
+    anchor_settings = {
+        'prompt': prompt,
+        'negative_prompt': negative_prompt,
+        'seed': seed,
+        'model': config['model'],
+        'scale': config['scale'],
+        'num_inference_steps': num_inference_steps,
+        'latent_shape': list(latent.shape),
+        'kv_dtype': kv_store.dtype,
+        'kv_layout': 'timestep',
+        'kv_blocks': config.get('kv_cache', {}).get('blocks'),
+        'kv_timesteps': config.get('kv_cache', {}).get('timesteps'),
+        'kv_share_guidance': attention.share_guidance,
+        # when the ControlNets run, in which dtype everything runs and where the conditions come from
+        'controlnet_schedule': {key: value for key, value in config.get('controlnet_schedule', {}).items()
+                                if key != 'report'},
+        'dtype': str(pipe.unet.dtype),
+        'condition_cache': condition_cache is not None,
+    }
+
+
+# module state that belongs to a loaded pipeline rather than to a job
+PIPELINE_STATE = ('pipe', 'kv_store', 'attention', 'guidance', 'prompt_cache', 'controlnet_report',
+                  'anchor_scheduler', 'attention_profiler')
+PIPELINE_CONFIG = ('model', 'kv_cache', 'controlnet_schedule', 'prompt_cache', 'compile')
+
+
+def pipeline_key(config, device):
+    return json.dumps([device] + [config.get(section) for section in PIPELINE_CONFIG], sort_keys=True)
+
+
+def activate_pipeline(config, device, pool, pool_size=1):
+    r"""
+      Makes the pipeline `config` asks for the current one, loading it only if `pool` does not
+      hold it yet. The pool keeps the `pool_size` most recently used pipelines.
+      """
+    key = pipeline_key(config, device)
+    if key in pool:
+        state = pool.pop(key)
+        globals().update(state)
+    else:
+        # the current pipeline is also referenced by the module globals, drop those too so an
+        # evicted pipeline is freed before the next one is loaded
+        globals().update(dict.fromkeys(PIPELINE_STATE))
+        while pool and len(pool) >= pool_size:
+            pool.pop(next(iter(pool)))
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        with tracer.span("load_pipeline"):
+            load_pipeline(config, device)
+        state = {name: globals()[name] for name in PIPELINE_STATE}
+    pool[key] = state
+
+
+def serve(config, queue_dir, device='cuda', once=False):
+    r"""
+      Renders the jobs queued in `queue_dir` one after the other with warm pipelines. Each job
+      is a YAML config merged over `config`, usually with its own prompt, data and output folders.
+      Jobs that change the model, cache or ControlNet sections get their own pipeline, the
+      `serve.pool_size` most recently used ones stay loaded. The attention state is reset
+      between jobs. Queue depth and per-job latency are printed and kept in status.json.
+      """
+    from utils.job_queue import JobQueue
+    serve_config = config.get('serve', {})
+    poll_interval = serve_config.get('poll_interval', 1.0)
+    queue = JobQueue(queue_dir)
+    pool = {}
+    latencies = []
+    failed = 0
+    print(f"Serving jobs from {queue_dir}, {len(queue)} queued")
+    while True:
+        job = queue.claim()
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        name = os.path.basename(job)
+        print(f"[{name}] started, {len(queue)} queued")
+        queue.write_status({"running": name, "completed": len(latencies), "failed": failed,
+                            "mean_latency_s": sum(latencies) / len(latencies) if latencies else None})
+        start = time.perf_counter()
+        error = None
+        try:
+            job_config = merge_config(copy.deepcopy(config), load_config(job))
+            activate_pipeline(job_config, device, pool, serve_config.get('pool_size', 1))
+            attention.reset()
+            attention.reset_stats()
+            with tracer.span("setup_job", job=name):
+                setup_job(job_config)
+            generation_config = job_config.get('generation', {})
+            with tracer.span("job", job=name):
+                generate_video_sequence(batch_size=generation_config.get('batch_size', 1),
+                                        resume=generation_config.get('resume', False))
+        except Exception:
+            error = traceback.format_exc()
+        except BaseException:
+            # interrupted, the job goes back to the queue
+            queue.release(job)
+            raise
+        latency = time.perf_counter() - start
+        queue.finish(job, error)
+        if error:
+            failed += 1
+            print(f"[{name}] failed after {latency:.1f}s, {len(queue)} queued\n{error}")
+        else:
+            latencies.append(latency)
+            frames = len(depth)
+            print(f"[{name}] done in {latency:.1f}s ({latency / frames:.2f}s per frame), {len(queue)} queued")
+        queue.write_status({"running": None, "completed": len(latencies), "failed": failed,
+                            "last_latency_s": latency,
+                            "mean_latency_s": sum(latencies) / len(latencies) if latencies else None})
+
+
+if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="Load YAML configuration file.")
+    parser.add_argument('config_path', help="Path to the YAML configuration file.")
+    parser.add_argument('--serve', metavar='QUEUE_DIR', default=None,
+                        help="Keep the pipeline loaded and render the job configs queued in this folder.")
+    parser.add_argument('--once', action='store_true', help="With --serve, exit once the queue is empty.")
+    parser.add_argument('--decode', action='store_true',
+                        help="Decode the latents saved by an earlier run (decode.save_latents) again and exit.")
+    parser.add_argument('--snapshot', metavar='PATH', default=None,
+                        help="Write the assembled fp16 pipeline to a safetensors file for model.snapshot and exit.")
+    args = parser.parse_args()
+    config = load_config(args.config_path)
+    sharding_config = config.get('sharding', {})
+    devices = sharding_config.get('devices') or []
+    if not devices:
+        # CUDA is initialized lazily, the visible device can still be chosen after importing torch
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(config['system']['gpu_id'])
+    if sharding_config.get('threads'):
+        torch.set_num_threads(sharding_config['threads'])
+
+    device = devices[0] if devices else config['system'].get('device', 'cuda')
+    setup_tracing(config, device)
+    if args.snapshot:
+        from utils.snapshot import save_snapshot
+        load_pipeline(config, device)
+        save_snapshot(pipe, args.snapshot, dtype=torch.float16)
+        print(f"Pipeline snapshot written to {args.snapshot}, set model.snapshot to load it")
+        raise SystemExit
+    if args.serve:
+        serve(config, args.serve, device, once=args.once)
+        write_trace(config)
+        raise SystemExit
+    with tracer.span("load_pipeline"):
+        load_pipeline(config, device)
+    with tracer.span("setup_job"):
+        setup_job(config)
+    if args.decode:
+        decode_saved_latents()
+        write_trace(config)
+        raise SystemExit
+
+    generation_config = config.get('generation', {})
+    if len(devices) > 1:
+        generate_sharded_sequence(config, devices,
+                                  batch_size=generation_config.get('batch_size', 1),
+                                  resume=generation_config.get('resume', False),
+                                  threads=sharding_config.get('threads'))
+    else:
+        generate_video_sequence(batch_size=generation_config.get('batch_size', 1),
+                                resume=generation_config.get('resume', False))
+    write_trace(config)
@@ -1,6 +1,186 @@
+import time
+
 import torch
 from diffusers.models.attention_processor import Attention
 
+from .kv_store import HostKVStore
+from .tracing import NullTracer
+
+
+def broadcast_cat(states, anchor):
+    r"""
+      Appends the cached `anchor` keys or values to `states` along the sequence dimension.
+
+      `anchor` holds one sample per guidance branch (and variant, see `AttentionController`). When
+      several frames are denoised in one batch, `states` holds the same samples with the frames
+      stacked inside each of them, so the anchor is broadcast over the frames of its sample
+      instead of being stored once per frame.
+      """
+    groups = anchor.shape[0]
+    states = states.view(groups, -1, *states.shape[1:])
+    anchor = anchor.unsqueeze(1).expand(-1, states.shape[1], -1, -1, -1)
+    return torch.cat((states, anchor), dim=3).flatten(0, 1)
+
+
+def chunked_anchor_attention(query, key, value, anchor_key, anchor_value, alpha=1.0, chunk_size=1024):
+    r"""
+      Attention of `query` over the frame's own keys and the cached anchor keys, equal to
+      `scaled_dot_product_attention(query, broadcast_cat(alpha * key, anchor_key),
+      broadcast_cat(value, anchor_value))` without building the concatenated keys and values.
+
+      Queries are processed `chunk_size` tokens at a time. For each chunk the scores against the
+      two key blocks are computed separately, shifted by their joint maximum and normalized by
+      their joint sum (the log-sum-exp of both blocks), so only one chunk of scores exists at a
+      time and the anchor is broadcast over the frames of its guidance branch without a copy.
+      Like the fused kernel, the softmax and the weighted sums accumulate in at least float32
+      (float64 inputs stay float64); the output is cast back to the input dtype.
+      """
+    groups = anchor_key.shape[0]
+    accumulate = torch.promote_types(query.dtype, torch.float32)
+    scale = query.shape[-1] ** -0.5
+    # (branches, frames, heads, tokens, head_dim), the anchor broadcasts over the frames
+    query = query.view(groups, -1, *query.shape[1:])
+    key = key.view(groups, -1, *key.shape[1:]).transpose(-1, -2)
+    value = value.view(groups, -1, *value.shape[1:]).to(accumulate)
+    anchor_key = anchor_key.unsqueeze(1).transpose(-1, -2)
+    anchor_value = anchor_value.unsqueeze(1).to(accumulate)
+
+    output = torch.empty_like(query)
+    for start in range(0, query.shape[-2], chunk_size):
+        chunk = query[..., start:start + chunk_size, :] * scale
+        self_scores = ((chunk * alpha) @ key).to(accumulate)
+        anchor_scores = (chunk @ anchor_key).to(accumulate)
+        shift = torch.maximum(self_scores.amax(dim=-1, keepdim=True), anchor_scores.amax(dim=-1, keepdim=True))
+        self_scores = self_scores.sub_(shift).exp_()
+        anchor_scores = anchor_scores.sub_(shift).exp_()
+        total = self_scores.sum(dim=-1, keepdim=True) + anchor_scores.sum(dim=-1, keepdim=True)
+        chunk_output = self_scores.div_(total) @ value
+        chunk_output += anchor_scores.div_(total) @ anchor_value
+        output[..., start:start + chunk_size, :] = chunk_output
+    return output.flatten(0, 1)
+
+
+class AttentionController:
+    r"""
+      State shared by all `Cross_Frame_Attention` processors of a UNet: the anchor cache, the
+      attention mode and alpha, and the timestep of the current UNet call.
+
+      The processors are registered once and read this object on every call, so switching between
+      the initial frame and the subsequent frames, or to the next sequence, only changes a few
+      attributes here instead of walking the module tree and re-registering the processors.
+
+      `attach` installs a forward pre-hook that records the timestep of every UNet call, which
+      addresses the cache entries together with the layer name and the guidance branch.
+
+      Branches are numbered in the order they are stored, the conditional one always last. When
+      the UNet batch holds fewer branches than were stored (guidance was truncated, see
+      `utils.guidance`), only the last ones are read. When it holds more (the anchor step ran
+      without guidance, or `share_guidance` is set), the stored branch is attended to from every
+      branch of the batch.
+
+      Several variants (prompts and seeds) of the same sequence can be denoised in one batch.
+      Inside each guidance branch the batch then holds the variants in turn, each with its own
+      anchor: the cache stores one entry per branch and variant, in the batch order.
+
+      Attributes:
+          kv_store (KVStore): Keys and values of the initial frame, see `utils.kv_store`.
+          mode (str): "keep" stores the keys and values of the frame being denoised, "replace"
+                      attends to the stored ones in addition to the frame's own.
+          alpha (float): Scale of the frame's own keys in "replace" mode.
+          timestep (int): Timestep of the current UNet call.
+          branches (int): Guidance branches in the current UNet batch, None for as many as stored.
+          variants (int): Variants in each guidance branch of the batch.
+          share_guidance (bool): Store only the conditional branch of the initial frame, which
+                                 halves the cache, and attend to it from both branches.
+          chunk_size (int): Query tokens per chunk of `chunked_anchor_attention` in "replace"
+                            mode, None concatenates the keys for `scaled_dot_product_attention`.
+          hits (int): Cache entries read in "replace" mode.
+          stored_bytes (int): Bytes of keys and values handed to the store in "keep" mode.
+          transfer_time (float): Seconds spent storing and reading entries, as seen by the host.
+          tracer (Tracer): Records every store and read as a stage when tracing.kv is set.
+      """
+
+    def __init__(self, kv_store=None, alpha=1.0):
+        self.kv_store = kv_store if kv_store is not None else HostKVStore()
+        self.mode = "keep"
+        self.alpha = alpha
+        self.timestep = None
+        self.branches = None
+        self.variants = 1
+        self.share_guidance = False
+        self.chunk_size = None
+        self.handle = None
+        self.tracer = NullTracer()
+        self.reset_stats()
+
+    def attach(self, unet):
+        if self.handle is None:
+            self.handle = unet.register_forward_pre_hook(self._set_timestep, with_kwargs=True)
+
+    def _set_timestep(self, unet, args, kwargs):
+        timestep = args[1] if len(args) > 1 else kwargs['timestep']
+        if torch.is_tensor(timestep):
+            timestep = timestep.flatten()[0]
+        self.timestep = int(round(float(timestep)))
+
+    def keep(self, alpha=None):
+        self.mode = "keep"
+        if alpha is not None:
+            self.alpha = alpha
+
+    def replace(self, alpha=None):
+        self.mode = "replace"
+        if alpha is not None:
+            self.alpha = alpha
+
+    def reset(self):
+        self.kv_store.clear()
+        self.mode = "keep"
+        self.timestep = None
+
+    def reset_stats(self):
+        self.hits = 0
+        self.stored_bytes = 0
+        self.transfer_time = 0.0
+
+    def store(self, name, key, value, query=None):
+        # one entry per guidance branch (unconditional, conditional) and variant of the initial frame
+        start = time.perf_counter()
+        if self.share_guidance:
+            key, value = key[-self.variants:], value[-self.variants:]
+            query = None if query is None else query[-self.variants:]
+        with self.tracer.span("kv_store", "kv", layer=name, timestep=self.timestep):
+            for branch in range(key.shape[0]):
+                self.kv_store.put((name, self.timestep, branch),
+                                  (key[branch:branch + 1], value[branch:branch + 1]),
+                                  query=None if query is None else query[branch:branch + 1])
+        self.transfer_time += time.perf_counter() - start
+        self.stored_bytes += key.numel() * key.element_size() + value.numel() * value.element_size()
+
+    def load(self, name, device):
+        start = time.perf_counter()
+        timestep = self.kv_store.nearest_timestep(name, self.timestep)
+        stored = 0
+        while (name, timestep, stored) in self.kv_store:
+            stored += 1
+        wanted = stored if self.branches is None else self.branches * self.variants
+        first = max(stored - wanted, 0)
+        with self.tracer.span("kv_load", "kv", layer=name, timestep=timestep):
+            branches = [self.kv_store.get((name, timestep, branch), device) for branch in range(first, stored)]
+        self.transfer_time += time.perf_counter() - start
+        self.hits += len(branches)
+        if len(branches) == 1:
+            return branches[0]
+        if len(branches) < wanted:
+            # the stored branch of every variant serves each branch of the batch in turn
+            branches = branches * (wanted // len(branches))
+        return tuple(torch.cat(tensors) for tensors in zip(*branches))
+
+    def format_stats(self):
+        return (f"anchor cache: {len(self.kv_store)} entries, {self.kv_store.nbytes / 2 ** 20:.1f} MB held, "
+                f"{self.stored_bytes / 2 ** 20:.1f} MB stored, {self.hits} hits, "
+                f"{self.transfer_time * 1000:.0f} ms in transfers")
+
 
 class Cross_Frame_Attention:
     r"""
@@ -15,21 +195,34 @@ class Cross_Frame_Attention:
       and temporal coherence across frames, such as stable video generation.
 
       Attributes:
-          k (list): Stores the keys for the attention mechanism from each frame.
-          v (list): Stores the values for the attention mechanism from each frame.
-          index (int): Tracks the current frame index in the sequence.
+          controller (AttentionController): Mode, alpha, current timestep and anchor cache, shared
+                                            by all processors of a UNet.
+          name (str): Name of the attention layer, used to address its entries in the cache.
           forever_keep (bool): Determines whether the initial frame's attention is always
                                kept throughout the sequence.
+          timesteps (tuple): Range [low, high] of diffusion timesteps in which the layer caches
+                             and reuses the initial frame, plain self-attention outside of it.
+                             None caches at every timestep.
+
+      Cached keys and values are addressed by (layer, timestep, guidance branch). A subsequent
+      frame reads the entries of the stored timestep nearest to its own, so it does not need the
+      scheduler or the number of steps of the initial frame.
 
       The processor integrates with attention layers in neural networks and modifies the attention
       weights and values based on the specified mode and the current frame in the sequence.
       """
 
-    def __init__(self, forever_keep=None):
-        self.k = []
-        self.v = []
-        self.index = 0
+    def __init__(self, forever_keep=None, controller=None, name=None, timesteps=None):
+        self.controller = controller if controller is not None else AttentionController()
+        self.name = name
         self.forever_keep = forever_keep
+        self.timesteps = timesteps
+
+    def caches(self):
+        if self.timesteps is None:
+            return True
+        low, high = self.timesteps
+        return low <= self.controller.timestep <= high
 
     def __call__(
             self,
@@ -41,10 +234,8 @@ class Cross_Frame_Attention:
             scale: float = 1.0,
             **cross_attention_kwargs
     ):
-        self.alpha = cross_attention_kwargs['alpha']
-        self.tensor_device = hidden_states.device
-
-        assert cross_attention_kwargs['att_mode'] in ["replace", "keep"]
+        controller = self.controller
+        assert controller.mode in ["replace", "keep"]
 
         residual = hidden_states
 
@@ -74,8 +265,9 @@ class Cross_Frame_Attention:
         self_key = attn.to_k(encoder_hidden_states, scale=scale)
         self_value = attn.to_v(encoder_hidden_states, scale=scale)
 
-        if not self.forever_keep:
-            if cross_attention_kwargs['att_mode'] == "keep":
+        attended = None
+        if not self.forever_keep and self.caches():
+            if controller.mode == "keep":
                 key = attn.to_k(encoder_hidden_states,
                                 scale=scale)
                 value = attn.to_v(encoder_hidden_states,
@@ -87,13 +279,9 @@ class Cross_Frame_Attention:
                 key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
                 value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
-                self.k.append(key.to("cpu"))
-                self.v.append(value.to("cpu"))
+                controller.store(self.name, key, value, query=query)
             else:
-                assert self.k is not None and self.v is not None
-                key = self.k[self.index].to(query.device)
-
-                value = self.v[self.index].to(query.device)
+                key, value = controller.load(self.name, query.device)
 
                 inner_dim = self_key.shape[-1]
                 head_dim = inner_dim // attn.heads
@@ -102,11 +290,13 @@ class Cross_Frame_Attention:
 
                 self_key = self_key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
                 self_value = self_value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
-                self_key = self.alpha * self_key
-                key = torch.cat((self_key, key), dim=2)
-                value = torch.cat((self_value, value), dim=2)
-
-                self.index = self.index + 1
+                if controller.chunk_size and attention_mask is None:
+                    attended = chunked_anchor_attention(query, self_key, self_value, key, value,
+                                                        alpha=controller.alpha, chunk_size=controller.chunk_size)
+                else:
+                    self_key = controller.alpha * self_key
+                    key = broadcast_cat(self_key, key)
+                    value = broadcast_cat(self_value, value)
         else:
             key = attn.to_k(encoder_hidden_states, scale=scale)
             value = attn.to_v(encoder_hidden_states, scale=scale)
@@ -116,11 +306,12 @@ class Cross_Frame_Attention:
             key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
             value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
 
-        hidden_states = torch.nn.functional.scaled_dot_product_attention(
-            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
-        )
+        if attended is None:
+            attended = torch.nn.functional.scaled_dot_product_attention(
+                query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False
+            )
 
-        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = attended.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
         hidden_states = hidden_states.to(query.dtype)
 
         hidden_states = attn.to_out[0](hidden_states, scale=scale)
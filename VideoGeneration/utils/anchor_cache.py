@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+
+import torch
+from PIL import Image
+
+
+def anchor_cache_key(settings, conds):
+    r"""
+      Content address of an initial frame: a hash of every setting that changes its image or its
+      cached keys and values (prompts, seed, model ids, alpha, scales, ...) and of the raw pixels
+      of its depth and canny conditions.
+      """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode())
+    for image in conds:
+        digest.update(f"{image.mode}{image.size}".encode())
+        digest.update(image.tobytes())
+    return digest.hexdigest()[:32]
+
+
+class AnchorCache:
+    r"""
+      On-disk cache of initial frames. Each entry is a folder named after its `anchor_cache_key`
+      holding the generated image and the state of the KV store after the "keep" pass, so a rerun
+      with the same settings can render subsequent frames without regenerating frame 0.
+
+      Attributes:
+          directory (str): Root folder of the cache.
+      """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path(key), "kv.pt"))
+
+    def load(self, key, kv_store, device):
+        folder = self.path(key)
+        kv_store.load_state_dict(torch.load(os.path.join(folder, "kv.pt"), map_location="cpu"), device)
+        with Image.open(os.path.join(folder, "image.png")) as image:
+            return image.copy()
+
+    def save(self, key, kv_store, image, settings=None):
+        folder = self.path(key)
+        os.makedirs(folder, exist_ok=True)
+        image.save(os.path.join(folder, "image.png"))
+        if settings is not None:
+            with open(os.path.join(folder, "settings.json"), "w") as file:
+                json.dump(settings, file, indent=2, default=str)
+        # kv.pt marks a complete entry, so it is written last and moved into place atomically
+        torch.save(kv_store.state_dict(), os.path.join(folder, "kv.pt.tmp"))
+        os.replace(os.path.join(folder, "kv.pt.tmp"), os.path.join(folder, "kv.pt"))
@@ -0,0 +1,112 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+def save_png(image, path):
+    r"""
+      Writes `image` next to `path` and renames it into place, so an interrupted write never
+      leaves a truncated PNG that a resumed run would take for a rendered frame.
+      """
+    image.save(path + ".tmp", format="PNG")
+    os.replace(path + ".tmp", path)
+
+
+class AsyncFrameWriter:
+    r"""
+      Output stage that takes PNG encoding and video muxing off the main thread, so the
+      accelerator does not wait for the disk between two denoising runs.
+
+      PNGs are encoded by a small thread pool, video frames by a dedicated thread that keeps them
+      in order. At most `max_pending` tasks are queued; submitting more blocks until one finishes,
+      which bounds the memory held by frames waiting to be written. The first error raised by a
+      task is re-raised on the main thread by the next `save`, `append_video` or `flush`.
+
+      Attributes:
+          output_dir (str): Folder for the PNGs, created once.
+          video (StreamingVideoWriter): Optional video fed by `append_video`, closed with the writer.
+          tracer (Tracer): Optional, records each write as a stage on the thread that does it.
+      """
+
+    def __init__(self, output_dir, video=None, max_workers=2, max_pending=8, tracer=None):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.video = video
+        self.tracer = tracer
+        self.images = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="png")
+        self.muxer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="video")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def save(self, image, name):
+        self._submit(self.images, self._traced("save_png", save_png), image, os.path.join(self.output_dir, name))
+
+    def append_video(self, image):
+        r"""Appends a PIL image, or the frame stored at a path, to the video."""
+        self._submit(self.muxer, self._traced("append_video", self._append_video), image)
+
+    def _traced(self, name, fn):
+        if self.tracer is None or not self.tracer.enabled:
+            return fn
+
+        def traced(*args):
+            with self.tracer.span(name, "io"):
+                return fn(*args)
+
+        return traced
+
+    def _append_video(self, image):
+        if isinstance(image, str):
+            with Image.open(image) as frame:
+                self.video.append(frame)
+        else:
+            self.video.append(image)
+
+    def _submit(self, executor, fn, *args):
+        self._raise_errors()
+        self.slots.acquire()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def _raise_errors(self):
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise RuntimeError("Writing an output frame failed") from future.exception()
+        self.futures = pending
+
+    def flush(self):
+        for future in self.futures:
+            future.exception()
+        self._raise_errors()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.images.shutdown(wait=True)
+            self.muxer.shutdown(wait=True)
+            if self.video is not None:
+                self.video.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+            return
+        # keep the original exception, but still finish the frames that were already queued
+        try:
+            self.close()
+        except RuntimeError:
+            pass
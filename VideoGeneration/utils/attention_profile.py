@@ -0,0 +1,89 @@
+import time
+
+import torch
+
+
+def block_name(layer):
+    r"""UNet block of an attention layer, e.g. "down_blocks.1" or "mid_block"."""
+    return layer.split(".attentions")[0]
+
+
+class AttentionProfiler:
+    r"""
+      Measures the wall time of every self-attention (`attn1`) layer of a UNet through forward
+      hooks, and reports it per block next to the memory the anchor cache holds for that block.
+      The report shows what caching costs where, and so which blocks `kv_cache.blocks` and
+      `kv_cache.timesteps` are worth restricting.
+
+      Timings synchronize the device around each attention call, which slows generation down.
+      The attention mode of each call is read from the `controller` of the processors.
+
+      Attributes:
+          times (dict): Maps (block, attention mode) to [seconds, calls].
+          cached (set): Names of the layers whose processor caches keys and values.
+          layers (dict): Maps each block to its number of self-attention layers.
+      """
+
+    def __init__(self, unet, controller):
+        self.controller = controller
+        self.times = {}
+        self.layers = {}
+        self.cached = {name[:-len(".processor")] for name, processor in unet.attn_processors.items()
+                       if name.endswith("attn1.processor") and not getattr(processor, "forever_keep", True)}
+        self.handles = []
+        for name, module in unet.named_modules():
+            if name.endswith("attn1"):
+                block = block_name(name)
+                self.layers[block] = self.layers.get(block, 0) + 1
+                self.handles.append(module.register_forward_pre_hook(self._start, with_kwargs=True))
+                self.handles.append(module.register_forward_hook(self._stop_hook(block)))
+        self._started = None
+
+    def _start(self, module, args, kwargs):
+        hidden_states = args[0] if args else kwargs["hidden_states"]
+        if hidden_states.is_cuda:
+            torch.cuda.synchronize(hidden_states.device)
+        self._started = (time.perf_counter(), self.controller.mode)
+
+    def _stop_hook(self, block):
+        def stop(module, args, output):
+            if output.is_cuda:
+                torch.cuda.synchronize(output.device)
+            started, mode = self._started
+            stats = self.times.setdefault((block, mode), [0.0, 0])
+            stats[0] += time.perf_counter() - started
+            stats[1] += 1
+
+        return stop
+
+    def reset(self):
+        self.times = {}
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def format_report(self, kv_store=None):
+        cache_bytes = {}
+        if kv_store is not None:
+            for layer, nbytes in kv_store.layer_nbytes().items():
+                block = block_name(layer)
+                cache_bytes[block] = cache_bytes.get(block, 0) + nbytes
+        cached_layers = {}
+        for layer in self.cached:
+            cached_layers[block_name(layer)] = cached_layers.get(block_name(layer), 0) + 1
+
+        lines = [f"{'block':<16}{'cached':>8}{'cache MB':>10}{'keep ms':>10}{'replace ms':>12}{'calls':>8}"]
+        total_bytes = 0
+        for block, count in self.layers.items():
+            keep = self.times.get((block, "keep"), [0.0, 0])
+            replace = self.times.get((block, "replace"), [0.0, 0])
+            total_bytes += cache_bytes.get(block, 0)
+            lines.append(f"{block:<16}{str(cached_layers.get(block, 0)) + '/' + str(count):>8}"
+                         f"{cache_bytes.get(block, 0) / 2 ** 20:>10.1f}{keep[0] * 1000:>10.1f}"
+                         f"{replace[0] * 1000:>12.1f}{keep[1] + replace[1]:>8}")
+        lines.append(f"{'total':<16}{len(self.cached):>8}{total_bytes / 2 ** 20:>10.1f}"
+                     f"{sum(t for (_, mode), (t, _) in self.times.items() if mode == 'keep') * 1000:>10.1f}"
+                     f"{sum(t for (_, mode), (t, _) in self.times.items() if mode == 'replace') * 1000:>12.1f}")
+        return "\n".join(lines)
@@ -0,0 +1,63 @@
+import os
+
+import torch
+
+from .Cross_Frame_Attention import Cross_Frame_Attention
+
+# every attention layer and block is its own module instance with its own shapes, and each
+# compiles its own graphs from the same code objects
+CACHE_SIZE_LIMIT = 512
+
+
+def set_compile_cache(directory):
+    r"""
+      Keeps the artifacts of torch.compile in `directory` instead of a temporary folder: the
+      kernels generated by Inductor and Triton and, on PyTorch versions that have it, the compiled
+      FX graphs. A later run (or shard worker) with the same models and shapes then skips the
+      code generation and most of the compilation.
+      """
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = directory
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(directory, "triton")
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, "fx_graph_cache"):
+        inductor_config.fx_graph_cache = True
+    return directory
+
+
+def compile_pipeline(pipe, controller, backend="inductor", mode=None, cache_dir=None):
+    r"""
+      Compiles the forward of the UNet and of every ControlNet with torch.compile and static
+      shapes, the `Cross_Frame_Attention` processors included: their projections and the
+      attention over the frame's own and the cached anchor keys ("replace" mode) are traced into
+      the UNet graphs. Storing and reading the anchor cache is plain Python and stays eager
+      between the compiled graphs, as do the hooks on the models themselves (tracing, guidance
+      truncation, the timestep of the controller).
+
+      Nothing is compiled until the first call. Every input shape compiles once: the initial
+      frame, the batches of subsequent frames, and a smaller last batch or truncated guidance
+      if the sequence has them. With `cache_dir` the artifacts persist between runs, see
+      `set_compile_cache`.
+      """
+    options = {"backend": backend, "mode": mode, "dynamic": False}
+    try:
+        unet_forward = torch.compile(pipe.unet.forward, **options)
+        controlnet_forwards = [torch.compile(net.forward, **options) for net in pipe.controlnet.nets]
+    except RuntimeError as error:
+        raise ValueError(f"compile.enabled requires torch.compile, which is not available here: {error}") from error
+
+    if cache_dir:
+        set_compile_cache(cache_dir)
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, CACHE_SIZE_LIMIT)
+    controller.store = torch._dynamo.disable(controller.store)
+    controller.load = torch._dynamo.disable(controller.load)
+    for processor in pipe.unet.attn_processors.values():
+        if isinstance(processor, Cross_Frame_Attention):
+            # reads the timestep of the controller, which would otherwise recompile every step
+            processor.caches = torch._dynamo.disable(processor.caches)
+
+    pipe.unet.forward = unet_forward
+    for net, forward in zip(pipe.controlnet.nets, controlnet_forwards):
+        net.forward = forward
+    return pipe
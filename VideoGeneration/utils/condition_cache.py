@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .utils_all import get_condition_images
+
+CACHE_VERSION = 2
+
+
+def source_fingerprint(data_dir, size=None):
+    r"""Names, sizes and modification times of every condition PNG under `data_dir`, and the cache size."""
+    files = []
+    for sub_folder in ("depth", "freestyle"):
+        folder = os.path.join(data_dir, sub_folder)
+        for name in sorted(os.listdir(folder)):
+            if '.png' in name:
+                stat = os.stat(os.path.join(folder, name))
+                files.append([sub_folder, name, stat.st_size, int(stat.st_mtime)])
+    return {"version": CACHE_VERSION, "size": None if size is None else list(size), "files": files}
+
+
+def condition_size(size, vae_scale_factor=8):
+    width, height = size
+    return width - width % vae_scale_factor, height - height % vae_scale_factor
+
+
+def build_condition_cache(data_dir, cache_dir, size=None, vae_scale_factor=8):
+    r"""
+      Converts the depth and freestyle maps of a Blender output folder into two stacked float16
+      arrays of shape (frames, 1, height, width) with values in [0, 1], which is what the SDXL
+      ControlNet image processor would produce from each PIL image resized to the output `size`
+      (width, height), by default the size of the maps (the three identical RGB channels are
+      restored on load). Frames are converted chunk by chunk straight into the memory-mapped
+      `.npy` files, so building the cache runs in constant memory.
+      """
+    depth, canny_images = get_condition_images(data_dir)
+    width, height = condition_size(size or depth.size, vae_scale_factor)
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, sequence in (("depth", depth), ("canny", canny_images)):
+        array = np.lib.format.open_memmap(os.path.join(cache_dir, f"{name}.npy.tmp"), mode="w+",
+                                          dtype=np.float16, shape=(len(sequence), 1, height, width))
+        for idx, image in enumerate(sequence):
+            if image.size != (width, height):
+                image = image.resize((width, height), resample=Image.LANCZOS)
+            array[idx, 0] = np.asarray(image, dtype=np.float32) / 255.0
+        array.flush()
+        del array
+        os.replace(os.path.join(cache_dir, f"{name}.npy.tmp"), os.path.join(cache_dir, f"{name}.npy"))
+    # the fingerprint is written last, it marks the cache as complete
+    with open(os.path.join(cache_dir, "source.json"), "w") as file:
+        json.dump(source_fingerprint(data_dir, size), file)
+
+
+class ConditionCache:
+    r"""
+      Memory-mapped conditioning tensors built by `build_condition_cache`.
+
+      `batch` returns, for a list of frame indices, one ready-to-use (B, 3, H, W) tensor
+      per ControlNet ([depth, canny]), already on the target device. The pipeline then skips all
+      PIL conversion and resizing for these frames. The cache only depends on the simulation and
+      the output size, so every run over the same Blender output reuses it whatever its prompt.
+
+      Attributes:
+          depth (np.memmap): (frames, 1, H, W) float16 depth conditions.
+          canny (np.memmap): (frames, 1, H, W) float16 freestyle (edge) conditions.
+      """
+
+    def __init__(self, cache_dir):
+        self.depth = np.load(os.path.join(cache_dir, "depth.npy"), mmap_mode="r")
+        self.canny = np.load(os.path.join(cache_dir, "canny.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.depth)
+
+    @property
+    def size(self):
+        return self.depth.shape[3], self.depth.shape[2]
+
+    def batch(self, indices, device="cpu"):
+        conds = []
+        for array in (self.depth, self.canny):
+            frames = torch.from_numpy(np.stack([array[i] for i in indices]))
+            # the ControlNet image processor works in float32, the conversion happens after the upload
+            conds.append(frames.to(device).float().expand(-1, 3, -1, -1))
+        return conds
+
+
+def load_condition_cache(data_dir, cache_dir=None, size=None, vae_scale_factor=8):
+    r"""Opens the cache of `data_dir` at `size`, (re)building it if it is missing, out of date or of another size."""
+    cache_dir = cache_dir or os.path.join(data_dir, ".condition_cache")
+    fingerprint_path = os.path.join(cache_dir, "source.json")
+    fingerprint = None
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path) as file:
+            fingerprint = json.load(file)
+    if fingerprint != source_fingerprint(data_dir, size):
+        print(f"Building condition cache for {data_dir} in {cache_dir}")
+        build_condition_cache(data_dir, cache_dir, size, vae_scale_factor)
+    return ConditionCache(cache_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute the ControlNet conditions of a Blender output folder.")
+    parser.add_argument('data_dir', help="Folder with the depth/ and freestyle/ sub-folders.")
+    parser.add_argument('--cache_dir', default=None, help="Defaults to <data_dir>/.condition_cache")
+    parser.add_argument('--size', type=int, nargs=2, default=None, metavar=("WIDTH", "HEIGHT"),
+                        help="Output size of the generation, defaults to the size of the maps.")
+    args = parser.parse_args()
+    cache = load_condition_cache(args.data_dir, args.cache_dir, args.size)
+    print(f"{len(cache)} frames of {cache.size[0]}x{cache.size[1]} ready")
@@ -0,0 +1,171 @@
+import time
+
+import torch
+from diffusers.pipelines.controlnet.multicontrolnet import MultiControlNetModel
+
+
+def count_flops(module, run):
+    r"""
+      Estimates the FLOPs of `run()` from the convolutions and linear layers of `module`
+      (2 per multiply-accumulate). Attention score products are not included.
+      """
+    flops = [0]
+
+    def conv_hook(layer, inputs, output):
+        kernel = layer.kernel_size[0] * layer.kernel_size[1]
+        flops[0] += 2 * output.numel() * (layer.in_channels // layer.groups) * kernel
+
+    def linear_hook(layer, inputs, output):
+        flops[0] += 2 * output.numel() * layer.in_features
+
+    handles = []
+    for layer in module.modules():
+        if isinstance(layer, torch.nn.Conv2d):
+            handles.append(layer.register_forward_hook(conv_hook))
+        elif isinstance(layer, torch.nn.Linear):
+            handles.append(layer.register_forward_hook(linear_hook))
+    try:
+        result = run()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return result, flops[0]
+
+
+class ScheduledMultiControlNet(MultiControlNetModel):
+    r"""
+      Multi-ControlNet that runs each ControlNet only on the denoising steps its schedule selects.
+
+      Every ControlNet has a schedule with three entries:
+          start, end (float): Fraction of the denoising steps during which the ControlNet
+                              contributes at all, e.g. end=0.6 drops canny for the last 40%.
+          stride (int): Inside that window the ControlNet runs every `stride` steps, and the
+                        residuals of its last run are reused on the steps in between.
+      When no ControlNet contributes to a step, no residuals are passed to the UNet.
+
+      `reset` must be called with the number of denoising steps before each pipeline call. The
+      per-frame counters it clears are summarized by `format_stats`: runs, reused and skipped
+      steps per ControlNet, and the wall time and FLOPs these savings stand for, estimated from
+      the measured cost of a run (timings synchronize the device only when `profile` is set).
+
+      Attributes:
+          schedules (list): One dict with "start", "end" and "stride" per ControlNet.
+          names (list): Display names of the ControlNets.
+      """
+
+    def __init__(self, controlnets, schedules=None, names=None, profile=False):
+        super().__init__(controlnets)
+        schedules = schedules or [{} for _ in controlnets]
+        self.schedules = [
+            {"start": s.get("start", 0.0), "end": s.get("end", 1.0), "stride": max(1, int(s.get("stride", 1)))}
+            for s in schedules
+        ]
+        self.names = names or [f"controlnet_{i}" for i in range(len(controlnets))]
+        self.profile = profile
+        self.flops = [None] * len(controlnets)
+        self.run_time = [[0.0, 0] for _ in controlnets]
+        self.reset()
+
+    def reset(self, num_steps=None):
+        self.num_steps = num_steps
+        self.step = 0
+        self.residuals = [None] * len(self.nets)
+        self.last_run = [None] * len(self.nets)
+        self.stats = [{"run": 0, "reused": 0, "skipped": 0} for _ in self.nets]
+
+    def _progress(self, timestep):
+        if self.num_steps:
+            return self.step / self.num_steps
+        return 1.0 - float(timestep) / 1000
+
+    def forward(
+            self,
+            sample,
+            timestep,
+            encoder_hidden_states,
+            controlnet_cond,
+            conditioning_scale,
+            class_labels=None,
+            timestep_cond=None,
+            attention_mask=None,
+            added_cond_kwargs=None,
+            cross_attention_kwargs=None,
+            guess_mode=False,
+            return_dict=True,
+    ):
+        progress = self._progress(timestep)
+        down_block_res_samples, mid_block_res_sample = None, None
+        for i, (image, scale, controlnet) in enumerate(zip(controlnet_cond, conditioning_scale, self.nets)):
+            schedule = self.schedules[i]
+            if not schedule["start"] <= progress < schedule["end"]:
+                self.stats[i]["skipped"] += 1
+                continue
+
+            if self.last_run[i] is None or self.step - self.last_run[i] >= schedule["stride"]:
+                def run():
+                    return controlnet(
+                        sample=sample,
+                        timestep=timestep,
+                        encoder_hidden_states=encoder_hidden_states,
+                        controlnet_cond=image,
+                        conditioning_scale=scale,
+                        class_labels=class_labels,
+                        timestep_cond=timestep_cond,
+                        attention_mask=attention_mask,
+                        added_cond_kwargs=added_cond_kwargs,
+                        cross_attention_kwargs=cross_attention_kwargs,
+                        guess_mode=guess_mode,
+                        return_dict=False,
+                    )
+
+                if self.profile and sample.is_cuda:
+                    torch.cuda.synchronize(sample.device)
+                start = time.perf_counter()
+                if self.flops[i] is None:
+                    residuals, self.flops[i] = count_flops(controlnet, run)
+                else:
+                    residuals = run()
+                if self.profile and sample.is_cuda:
+                    torch.cuda.synchronize(sample.device)
+                self.run_time[i][0] += time.perf_counter() - start
+                self.run_time[i][1] += 1
+                self.residuals[i] = residuals
+                self.last_run[i] = self.step
+                self.stats[i]["run"] += 1
+            else:
+                self.stats[i]["reused"] += 1
+            down_samples, mid_sample = self.residuals[i]
+            if mid_sample.shape[0] > sample.shape[0]:
+                # guidance was truncated since these residuals were computed, keep the conditional half
+                down_samples = [d[-sample.shape[0]:] for d in down_samples]
+                mid_sample = mid_sample[-sample.shape[0]:]
+
+            # merge out of place, the residuals of a ControlNet may be reused on the next steps
+            if down_block_res_samples is None:
+                down_block_res_samples, mid_block_res_sample = list(down_samples), mid_sample
+            else:
+                down_block_res_samples = [
+                    samples_prev + samples_curr
+                    for samples_prev, samples_curr in zip(down_block_res_samples, down_samples)
+                ]
+                mid_block_res_sample = mid_block_res_sample + mid_sample
+
+        self.step += 1
+        return down_block_res_samples, mid_block_res_sample
+
+    def format_stats(self):
+        lines = []
+        total_time, total_flops = 0.0, 0
+        for i, name in enumerate(self.names):
+            stats = self.stats[i]
+            saved_runs = stats["reused"] + stats["skipped"]
+            seconds, runs = self.run_time[i]
+            saved_time = saved_runs * seconds / runs if runs else 0.0
+            saved_flops = saved_runs * (self.flops[i] or 0)
+            total_time += saved_time
+            total_flops += saved_flops
+            lines.append(f"{name}: ran {stats['run']}, reused {stats['reused']}, skipped {stats['skipped']} steps, "
+                         f"saved ~{saved_time * 1000:.0f} ms and ~{saved_flops / 1e9:.1f} GFLOPs")
+        lines.append(f"ControlNet schedule saved ~{total_time * 1000:.0f} ms and ~{total_flops / 1e9:.1f} GFLOPs "
+                     f"this frame")
+        return "\n".join(lines)
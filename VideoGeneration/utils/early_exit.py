@@ -0,0 +1,83 @@
+import functools
+
+
+class EarlyExit(Exception):
+    r"""Leaves the denoising loop of a pipeline call, carrying the final latents of its frames."""
+
+    def __init__(self, latents, steps):
+        super().__init__(f"denoising converged after {steps} steps")
+        self.latents = latents
+        self.steps = steps
+
+
+def predicted_original(scheduler, output, model_output, timestep, sample):
+    r"""Clean latents predicted at this step, from the scheduler output or from an epsilon prediction."""
+    original = getattr(output, "pred_original_sample", None)
+    if original is None and scheduler.config.prediction_type == "epsilon" and hasattr(scheduler, "alphas_cumprod"):
+        alpha = scheduler.alphas_cumprod[int(timestep)].to(device=sample.device, dtype=sample.dtype)
+        original = (sample - (1 - alpha).sqrt() * model_output) / alpha.sqrt()
+    return original
+
+
+class AdaptiveScheduler:
+    r"""
+      Wraps a diffusers scheduler and ends denoising once the latents stop changing.
+
+      After every step the relative L2 change of the tracked latents of each frame is measured,
+      either the predicted clean latents ("x0") or the noisy latents themselves ("latent"). Once
+      every frame of the batch changes by less than `threshold`, the step raises `EarlyExit`
+      with the clean latents predicted at that step, which is where the remaining steps would
+      lead; the caller decodes them. Until `min_fraction` of the steps has run nothing is checked.
+
+      Every other attribute is the wrapped scheduler's, so the wrapper can be set as
+      `pipe.scheduler`.
+
+      Attributes:
+          scheduler (SchedulerMixin): Wrapped scheduler.
+          threshold (float): Relative change between two steps under which denoising ends.
+          metric (str): "x0" or "latent", the latents whose change is measured.
+          min_fraction (float): Fraction of the steps that always run.
+          steps (int): Steps taken by the current or last pipeline call.
+          total_steps (int): Steps the current or last pipeline call was set up with.
+      """
+
+    def __init__(self, scheduler, threshold=0.005, metric="x0", min_fraction=0.3):
+        if metric not in ("x0", "latent"):
+            raise ValueError(f"Unknown early exit metric '{metric}', expected 'x0' or 'latent'")
+        self.scheduler = scheduler
+        self.threshold = threshold
+        self.metric = metric
+        self.min_fraction = min_fraction
+        self.steps = 0
+        self.total_steps = 0
+        self.previous = None
+
+        # the pipeline inspects the signature of `step` for the keyword arguments to pass
+        @functools.wraps(scheduler.step)
+        def step(*args, **kwargs):
+            return self._step(*args, **kwargs)
+
+        self.step = step
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler, name)
+
+    def set_timesteps(self, *args, **kwargs):
+        self.scheduler.set_timesteps(*args, **kwargs)
+        self.steps = 0
+        self.total_steps = len(self.scheduler.timesteps) // getattr(self.scheduler, "order", 1)
+        self.previous = None
+
+    def _step(self, model_output, timestep, sample, *args, return_dict=True, **kwargs):
+        output = self.scheduler.step(model_output, timestep, sample, *args, return_dict=True, **kwargs)
+        self.steps += 1
+        original = predicted_original(self.scheduler, output, model_output, timestep, sample)
+        tracked = original if self.metric == "x0" and original is not None else output.prev_sample
+
+        previous, self.previous = self.previous, tracked
+        if previous is not None and self.min_fraction * self.total_steps <= self.steps < self.total_steps:
+            change = (tracked - previous).float().flatten(1).norm(dim=1) \
+                / previous.float().flatten(1).norm(dim=1).clamp(min=1e-8)
+            if change.max() < self.threshold:
+                raise EarlyExit(original if original is not None else output.prev_sample, self.steps)
+        return output if return_dict else (output.prev_sample,)
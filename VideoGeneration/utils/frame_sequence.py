@@ -0,0 +1,127 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def to_gray(frames):
+    # same integer weights and rounding as PIL's RGB -> "L" conversion
+    if frames.ndim == 3:
+        return frames
+    rgb = frames[..., :3].astype(np.uint32)
+    return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+
+def invert_depth(frames):
+    return 255 - to_gray(frames)
+
+
+def last_channel(frames):
+    return frames if frames.ndim == 3 else np.ascontiguousarray(frames[..., -1])
+
+
+def decode(path):
+    with Image.open(path) as image:
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGBA")
+        return np.asarray(image)
+
+
+class FrameSequence:
+    r"""
+      Lazily decoded sequence of condition images, such as the depth or freestyle maps rendered
+      by Blender.
+
+      Frames are decoded in chunks on a background thread when first needed, and the chunks that
+      follow are prefetched while the current one is in use. The per-pixel transform (inversion,
+      alpha-channel extraction) runs once per chunk on the stacked uint8 array instead of once
+      per image. Only a few chunks are kept decoded at a time, so memory does not grow with the
+      length of the simulation.
+
+      Indexing returns single-channel PIL images; slicing returns another lazy sequence.
+
+      Attributes:
+          paths (list): PNG files of the sequence, in frame order.
+          transform (callable): Maps a (N, H, W[, C]) uint8 batch to a (N, H, W) uint8 batch.
+      """
+
+    def __init__(self, paths, transform, chunk_size=8, prefetch=2):
+        self.paths = list(paths)
+        self.transform = transform
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.chunks = OrderedDict()
+        self.pool = None
+
+    @classmethod
+    def from_folder(cls, path, transform, **kwargs):
+        names = sorted(name for name in os.listdir(path) if '.png' in name)
+        return cls([os.path.join(path, name) for name in names], transform, **kwargs)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return FrameSequence(self.paths[idx], self.transform, self.chunk_size, self.prefetch)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"frame {idx} out of range for a sequence of {len(self)} frames")
+        chunk = idx // self.chunk_size
+        self._schedule(chunk)
+        self.chunks.move_to_end(chunk)
+        future = self.chunks[chunk]
+        for ahead in range(chunk + 1, chunk + self.prefetch + 1):
+            self._schedule(ahead)
+        return future.result()[idx % self.chunk_size]
+
+    @property
+    def size(self):
+        with Image.open(self.paths[0]) as image:
+            return image.size
+
+    def sizes(self):
+        r"""Reads only the PNG headers, so this is cheap even for long sequences."""
+        sizes = []
+        for path in self.paths:
+            with Image.open(path) as image:
+                sizes.append(image.size)
+        return sizes
+
+    def _schedule(self, chunk):
+        if chunk in self.chunks or chunk * self.chunk_size >= len(self):
+            return
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frames")
+        self.chunks[chunk] = self.pool.submit(self._decode_chunk, chunk)
+        while len(self.chunks) > self.prefetch + 2:
+            self.chunks.popitem(last=False)
+
+    def _decode_chunk(self, chunk):
+        paths = self.paths[chunk * self.chunk_size:(chunk + 1) * self.chunk_size]
+        frames = [decode(path) for path in paths]
+        if all(f.shape == frames[0].shape for f in frames):
+            frames = self.transform(np.stack(frames))
+        else:
+            frames = [self.transform(f[None])[0] for f in frames]
+        return [Image.fromarray(frame, mode='L') for frame in frames]
+
+
+def check_condition_sequences(depth, freestyle):
+    if len(depth) != len(freestyle):
+        raise ValueError(f"Found {len(depth)} depth maps but {len(freestyle)} freestyle maps, "
+                         f"the two sequences must have one image per frame")
+    if len(depth) == 0:
+        raise ValueError("The condition sequences are empty")
+    depth_sizes, freestyle_sizes = depth.sizes(), freestyle.sizes()
+    for idx, (depth_size, freestyle_size) in enumerate(zip(depth_sizes, freestyle_sizes)):
+        if depth_size != depth_sizes[0] or freestyle_size != depth_sizes[0]:
+            raise ValueError(f"Frame {idx} has depth size {depth_size} and freestyle size {freestyle_size}, "
+                             f"expected {depth_sizes[0]} for every frame")
@@ -0,0 +1,88 @@
+import torch
+
+
+def conditional_half(value, batch_size):
+    r"""Second (conditional) half of every tensor in `value` whose batch holds both guidance branches."""
+    if torch.is_tensor(value):
+        return value[batch_size // 2:] if value.ndim and value.shape[0] == batch_size else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(conditional_half(item, batch_size) for item in value)
+    if isinstance(value, dict):
+        return {key: conditional_half(item, batch_size) for key, item in value.items()}
+    return value
+
+
+class GuidanceTruncation:
+    r"""
+      Stops classifier-free guidance after a fraction of the denoising steps.
+
+      The pipeline keeps stacking the unconditional and conditional branches on every step. Past
+      `end`, forward pre-hooks cut the inputs of the ControlNets and the UNet down to the
+      conditional half, and a forward hook returns the conditional noise prediction for both
+      halves, so the guidance formula of the pipeline yields it unchanged. The late steps then
+      cost one branch instead of two in every model and attention layer. The attention
+      `controller` is told how many branches the UNet batch holds, so the anchor cache follows.
+
+      `reset` must be called with the number of denoising steps, and the number of branches the
+      pipeline stacks (2 with classifier-free guidance, 1 without), before each pipeline call.
+
+      Attributes:
+          end (float): Fraction of the steps that run both branches, 1.0 keeps guidance throughout.
+          branches (int): Branches stacked by the pipeline, None leaves them to the controller.
+          controller (AttentionController): Attention state of the UNet, see `Cross_Frame_Attention`.
+          truncated_steps (int): Steps that ran the conditional branch only, since the last reset.
+      """
+
+    def __init__(self, controller=None, end=1.0):
+        self.controller = controller
+        self.end = end
+        self.handles = []
+        self.reset()
+
+    def attach(self, pipe):
+        if not self.handles:
+            self.handles = [
+                pipe.controlnet.register_forward_pre_hook(self._truncate_inputs, with_kwargs=True),
+                pipe.unet.register_forward_pre_hook(self._truncate_unet_inputs, with_kwargs=True),
+                pipe.unet.register_forward_hook(self._expand_output),
+            ]
+        return self
+
+    def reset(self, num_steps=None, end=None, branches=None):
+        self.num_steps = num_steps
+        if end is not None:
+            self.end = end
+        self.branches = branches
+        self.step = 0
+        self.truncated_steps = 0
+        if self.controller is not None:
+            self.controller.branches = None
+
+    def truncated(self):
+        return bool(self.num_steps) and self.step >= self.end * self.num_steps
+
+    def _truncate_inputs(self, module, args, kwargs):
+        if not self.truncated():
+            return None
+        sample = args[0] if args else kwargs["sample"]
+        batch_size = sample.shape[0]
+        return conditional_half(args, batch_size), conditional_half(kwargs, batch_size)
+
+    def _truncate_unet_inputs(self, module, args, kwargs):
+        truncated = self.truncated()
+        if self.controller is not None:
+            self.controller.branches = 1 if truncated else self.branches
+        if truncated:
+            self.truncated_steps += 1
+        return self._truncate_inputs(module, args, kwargs)
+
+    def _expand_output(self, module, args, output):
+        truncated = self.truncated()
+        self.step += 1
+        if not truncated:
+            return None
+        # both halves get the conditional prediction: uncond + scale * (cond - uncond) == cond
+        if isinstance(output, tuple):
+            return (torch.cat([output[0]] * 2),) + output[1:]
+        output.sample = torch.cat([output.sample] * 2)
+        return output
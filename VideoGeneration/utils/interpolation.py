@@ -0,0 +1,80 @@
+import cv2
+import numpy as np
+
+
+def resized_plane(image, size):
+    r"""Single-channel PIL image as a float32 array of `size` (width, height)."""
+    plane = np.asarray(image, dtype=np.float32)
+    if plane.shape[::-1] != tuple(size):
+        plane = cv2.resize(plane, tuple(size), interpolation=cv2.INTER_AREA)
+    return plane
+
+
+def motion_guide(depth, edges, size):
+    r"""Image the motion is estimated on: depth carries the shapes, the edge map their texture."""
+    guide = (resized_plane(depth, size) + resized_plane(edges, size)) / 2
+    return guide.round().astype(np.uint8)
+
+
+def estimate_flow(target, source):
+    r"""Dense flow with target[y, x] ~ source[y + flow[y, x, 1], x + flow[y, x, 0]] (Farneback)."""
+    return cv2.calcOpticalFlowFarneback(target, source, None, pyr_scale=0.5, levels=4, winsize=21,
+                                        iterations=3, poly_n=7, poly_sigma=1.5,
+                                        flags=cv2.OPTFLOW_FARNEBACK_GAUSSIAN)
+
+
+def upscale_flow(flow, size):
+    scale_x, scale_y = size[0] / flow.shape[1], size[1] / flow.shape[0]
+    flow = cv2.resize(flow, tuple(size), interpolation=cv2.INTER_LINEAR)
+    flow[..., 0] *= scale_x
+    flow[..., 1] *= scale_y
+    return flow
+
+
+def warp(image, flow):
+    height, width = flow.shape[:2]
+    grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    return cv2.remap(image, grid_x + flow[..., 0], grid_y + flow[..., 1], cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_REPLICATE)
+
+
+def interpolate_frame(previous, following, target, position, tolerance=0.03, flow_resolution=512):
+    r"""
+      Synthesizes a frame between two rendered keyframes from the condition maps of all three.
+
+      `previous` and `following` are (image, depth, edges) of the keyframes and `target` the
+      (depth, edges) of the frame, `position` its place between the keyframes in (0, 1). Each
+      keyframe is warped onto the frame with the motion estimated between their guide images.
+      A warped pixel is trusted when the keyframe's depth, warped the same way, lands within
+      `tolerance` (a fraction of the depth range) of the frame's own depth, which Blender
+      renders exactly. Trusted pixels are blended with weights falling off with the temporal
+      distance to their keyframe, the others take the plain temporal blend of both warps.
+      Motion is estimated with the longer side scaled down to `flow_resolution` pixels.
+
+      Returns the frame as an RGB array and its confidence: among the pixels whose depth differs
+      from either keyframe (the moving ones), the share that at least one warp is trusted for.
+      """
+    size = previous[0].size
+    scale = min(1.0, flow_resolution / max(size))
+    flow_size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+    target_depth = resized_plane(target[0], size)
+    target_guide = motion_guide(*target, flow_size)
+
+    warped, weights = [], []
+    moving = np.zeros(target_depth.shape, dtype=bool)
+    for (image, depth, edges), weight in ((previous, 1 - position), (following, position)):
+        depth = resized_plane(depth, size)
+        moving |= np.abs(depth - target_depth) > tolerance * 255
+        flow = upscale_flow(estimate_flow(target_guide, motion_guide(depth, edges, flow_size)), size)
+        trusted = np.abs(warp(depth, flow) - target_depth) <= tolerance * 255
+        warped.append(warp(np.asarray(image.convert("RGB"), dtype=np.float32), flow))
+        weights.append(weight * trusted.astype(np.float32))
+
+    total = weights[0] + weights[1]
+    covered = total > 0
+    blend = (1 - position) * warped[0] + position * warped[1]
+    trusted_blend = (weights[0][..., None] * warped[0] + weights[1][..., None] * warped[1]) \
+        / np.maximum(total, 1e-6)[..., None]
+    frame = np.where(covered[..., None], trusted_blend, blend)
+    confidence = float(covered[moving].mean()) if moving.any() else 1.0
+    return frame.round().clip(0, 255).astype(np.uint8), confidence
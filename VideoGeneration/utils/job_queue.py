@@ -0,0 +1,124 @@
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import socket
+import time
+
+
+class JobQueue:
+    r"""
+      Job queue kept in a folder, fed by dropping YAML job configs into it.
+
+      Jobs are taken oldest first. Claiming a job moves its file to the server's own
+      `running/<server>/` folder with an atomic rename, so a job is never picked twice even with
+      several servers on one queue, and finishing it moves the file to `done/` or `failed/` (next
+      to a `.error.txt` with the traceback). Each server holds a lock on its running folder for
+      as long as it lives; when a queue is opened, the jobs in the folders whose lock is free
+      (their server died) are queued again, as are those left in its own folder by an earlier
+      server with the same id (a restarted container keeps its hostname and PID). Files are only picked up once they end in `.yaml`,
+      `submit` writes them under a temporary name first.
+
+      Attributes:
+          directory (str): Folder of the queued jobs, with the running/, done/ and failed/
+                           sub-folders.
+          server_id (str): Name of this server's folder in running/, "<host>-<pid>" by default.
+      """
+
+    def __init__(self, directory, server_id=None):
+        self.directory = directory
+        self.server_id = server_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.running_dir = os.path.join(directory, "running", self.server_id)
+        for sub_folder in ("done", "failed"):
+            os.makedirs(os.path.join(directory, sub_folder), exist_ok=True)
+        os.makedirs(self.running_dir, exist_ok=True)
+        # held until the process exits, it tells other servers that these jobs are still rendering
+        self.lock = open(os.path.join(self.running_dir, ".lock"), "w")
+        fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.recover()
+
+    def _requeue(self, folder):
+        names = [name for name in os.listdir(folder) if name != ".lock"]
+        for name in names:
+            os.replace(os.path.join(folder, name), os.path.join(self.directory, name))
+        return len(names)
+
+    def recover(self):
+        r"""Queues again the jobs of servers that died while rendering them, returns their number."""
+        # this server holds its own lock, anything already in its folder was left by a predecessor
+        recovered = self._requeue(self.running_dir)
+        running = os.path.join(self.directory, "running")
+        for server_id in os.listdir(running):
+            folder = os.path.join(running, server_id)
+            if server_id == self.server_id or not os.path.isdir(folder):
+                continue
+            with open(os.path.join(folder, ".lock"), "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # that server is alive
+                    continue
+                recovered += self._requeue(folder)
+                os.remove(os.path.join(folder, ".lock"))
+            os.rmdir(folder)
+        return recovered
+
+    def pending(self):
+        names = [name for name in os.listdir(self.directory)
+                 if name.endswith((".yaml", ".yml")) and os.path.isfile(os.path.join(self.directory, name))]
+        paths = [os.path.join(self.directory, name) for name in names]
+        return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+    def __len__(self):
+        return len(self.pending())
+
+    def claim(self):
+        for path in self.pending():
+            running = os.path.join(self.running_dir, os.path.basename(path))
+            try:
+                os.replace(path, running)
+            except FileNotFoundError:
+                # claimed by another server in the meantime
+                continue
+            return running
+        return None
+
+    def release(self, job):
+        os.replace(job, os.path.join(self.directory, os.path.basename(job)))
+
+    def finish(self, job, error=None):
+        folder = os.path.join(self.directory, "failed" if error else "done")
+        os.replace(job, os.path.join(folder, os.path.basename(job)))
+        if error:
+            with open(os.path.join(folder, os.path.basename(job) + ".error.txt"), "w") as file:
+                file.write(error)
+
+    def write_status(self, status):
+        path = os.path.join(self.directory, "status.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(dict(status, queued=len(self), time=time.time()), file, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+def submit(directory, config_path):
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.basename(config_path)
+    if not name.endswith((".yaml", ".yml")):
+        name += ".yaml"
+    target = os.path.join(directory, name)
+    if os.path.exists(target):
+        root, ext = os.path.splitext(name)
+        target = os.path.join(directory, f"{root}_{time.time_ns()}{ext}")
+    shutil.copyfile(config_path, target + ".tmp")
+    os.replace(target + ".tmp", target)
+    return target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Queue job configs for a server started with main.py --serve.")
+    parser.add_argument('queue_dir', help="Folder watched by the server.")
+    parser.add_argument('configs', nargs="+", help="YAML job configs, merged over the server config.")
+    args = parser.parse_args()
+    for config_path in args.configs:
+        print(f"Queued {submit(args.queue_dir, config_path)}")
@@ -0,0 +1,349 @@
+import os
+import shutil
+import tempfile
+from bisect import bisect_left, insort
+
+import numpy as np
+import torch
+
+FLOAT8 = getattr(torch, "float8_e4m3fn", None)
+
+
+def quantize_int8(tensor):
+    # one scale per sample and attention head, taken over the sequence and head dimensions
+    scale = tensor.abs().amax(dim=(-2, -1), keepdim=True).float().clamp(min=1e-8) / 127
+    quantized = torch.round(tensor.float() / scale).clamp(-127, 127).to(torch.int8)
+    return quantized, scale.to(tensor.dtype)
+
+
+def quantize_fp8(tensor):
+    scale = tensor.abs().amax(dim=(-2, -1), keepdim=True).float().clamp(min=1e-8) / 448
+    return (tensor.float() / scale).to(FLOAT8), scale.to(tensor.dtype)
+
+
+def dequantize(quantized, scale):
+    return quantized.to(scale.dtype) * scale
+
+
+KV_CODECS = {
+    "int8": quantize_int8,
+    "fp8": quantize_fp8,
+}
+
+
+class KVStore:
+    r"""
+      Storage for the keys and values cached from the initial frame by `Cross_Frame_Attention`.
+
+      A single store is shared by every `attn1` processor of the UNet. Entries are tuples of
+      tensors addressed by a (layer, timestep, guidance branch) key and kept in insertion order,
+      which is also the order in which the attention layers ask for them again while rendering a
+      subsequent frame. `nearest_timestep` maps the timestep of a subsequent frame to the closest
+      one stored for a layer, so subsequent frames may use fewer steps or another scheduler.
+      Subclasses decide where an entry lives between being stored in "keep" mode and being
+      read back in "replace" mode.
+
+      With a `dtype` of "int8" or "fp8" every tensor is quantized with one scale per sample and
+      head before it leaves the device, and dequantized on the device when it is read back.
+
+      Attributes:
+          entries (dict): Maps each key to its stored tensors, in insertion order.
+          dtype (str): Compressed storage format, or None to keep the tensors as they are.
+          report (dict): When enabled, collects per layer the bytes before and after compression
+                         and the relative error that compression causes in the attention output.
+      """
+
+    placement = None
+
+    def __init__(self, dtype=None, report=False):
+        if dtype is not None and dtype not in KV_CODECS:
+            raise ValueError(f"Unknown kv cache dtype '{dtype}', expected one of {sorted(KV_CODECS)}")
+        if dtype == "fp8" and FLOAT8 is None:
+            raise ValueError("kv cache dtype 'fp8' requires torch.float8_e4m3fn (PyTorch 2.1 or newer)")
+        self.dtype = dtype
+        self.report = {} if report else None
+        self.entries = {}
+        self._keys = []
+        self._position = {}
+        self._timesteps = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return list(self._keys)
+
+    def put(self, key, tensors, query=None):
+        tensors = tuple(t.detach() for t in tensors)
+        encoded = self._encode(tensors)
+        if self.report is not None:
+            self._record(key, tensors, encoded, query)
+        if key not in self.entries:
+            self._add_key(key)
+        self.entries[key] = self._store(encoded)
+
+    def get(self, key, device):
+        return self._decode(self._fetch(key, torch.device(device)))
+
+    def next_key(self, key):
+        position = self._position[key] + 1
+        return self._keys[position % len(self._keys)]
+
+    def nearest_timestep(self, layer, timestep):
+        timesteps = self._timesteps[layer]
+        i = bisect_left(timesteps, timestep)
+        return min(timesteps[max(i - 1, 0):i + 1], key=lambda stored: abs(stored - timestep))
+
+    def clear(self):
+        self.entries = {}
+        self._keys = []
+        self._position = {}
+        self._timesteps = {}
+        if self.report is not None:
+            self.report = {}
+
+    @property
+    def nbytes(self):
+        return sum(self._entry_nbytes(stored) for stored in self.entries.values())
+
+    def layer_nbytes(self):
+        sizes = {}
+        for key, stored in self.entries.items():
+            sizes[key[0]] = sizes.get(key[0], 0) + self._entry_nbytes(stored)
+        return sizes
+
+    def state_dict(self):
+        # entries stay in their stored (possibly quantized) form and are moved to the host
+        cpu = torch.device("cpu")
+        return {
+            "dtype": self.dtype,
+            "entries": [(key, self._load(self.entries[key], cpu)) for key in self._keys],
+        }
+
+    def load_state_dict(self, state, device):
+        if state["dtype"] != self.dtype:
+            raise ValueError(f"kv cache was stored as {state['dtype']}, but the store uses {self.dtype}")
+        self.clear()
+        for key, encoded in state["entries"]:
+            self._add_key(key)
+            self.entries[key] = self._store(tuple(t.to(device) for t in encoded))
+
+    def _add_key(self, key):
+        self._position[key] = len(self._keys)
+        self._keys.append(key)
+        layer, timestep = key[:2]
+        timesteps = self._timesteps.setdefault(layer, [])
+        if timestep not in timesteps:
+            insort(timesteps, timestep)
+
+    def _encode(self, tensors):
+        if self.dtype is None:
+            return tensors
+        quantize = KV_CODECS[self.dtype]
+        return tuple(part for t in tensors for part in quantize(t))
+
+    def _decode(self, tensors):
+        if self.dtype is None:
+            return tensors
+        return tuple(dequantize(tensors[i], tensors[i + 1]) for i in range(0, len(tensors), 2))
+
+    def _record(self, key, tensors, encoded, query):
+        layer = key[0] if isinstance(key, tuple) else key
+        stats = self.report.setdefault(layer, {"bytes": 0, "stored_bytes": 0, "errors": []})
+        stats["bytes"] += sum(t.numel() * t.element_size() for t in tensors)
+        stats["stored_bytes"] += sum(t.numel() * t.element_size() for t in encoded)
+        if query is not None and len(tensors) == 2:
+            exact = torch.nn.functional.scaled_dot_product_attention(query, *tensors)
+            approx = torch.nn.functional.scaled_dot_product_attention(query, *self._decode(encoded))
+            error = (approx - exact).float().norm() / exact.float().norm().clamp(min=1e-8)
+            stats["errors"].append(error.item())
+
+    def format_report(self):
+        if not self.report:
+            return "kv cache report is empty, enable it with kv_cache.report"
+        lines = [f"{'layer':<72}{'raw MB':>9}{'stored MB':>11}{'mean err':>10}{'max err':>10}"]
+        total, stored = 0, 0
+        for layer, stats in self.report.items():
+            errors = stats["errors"] or [0.0]
+            total += stats["bytes"]
+            stored += stats["stored_bytes"]
+            lines.append(f"{layer:<72}{stats['bytes'] / 2 ** 20:>9.1f}{stats['stored_bytes'] / 2 ** 20:>11.1f}"
+                         f"{sum(errors) / len(errors):>10.4f}{max(errors):>10.4f}")
+        lines.append(f"{'total (' + str(self.dtype) + ')':<72}{total / 2 ** 20:>9.1f}{stored / 2 ** 20:>11.1f}"
+                     f"{'saved ' + format(1 - stored / max(total, 1), '.0%'):>20}")
+        return "\n".join(lines)
+
+    def _fetch(self, key, device):
+        return self._load(self.entries[key], device)
+
+    def _entry_nbytes(self, stored):
+        return sum(t.numel() * t.element_size() for t in stored)
+
+    def _store(self, tensors):
+        raise NotImplementedError
+
+    def _load(self, stored, device):
+        raise NotImplementedError
+
+
+class DeviceKVStore(KVStore):
+    r"""
+      Keeps every entry on the device that produced it, so "replace" mode reads it without a copy.
+      Fastest placement, but the whole anchor cache occupies accelerator memory.
+      """
+
+    placement = "device"
+
+    def _store(self, tensors):
+        return tensors
+
+    def _load(self, stored, device):
+        return tuple(t.to(device) for t in stored)
+
+
+class HostKVStore(KVStore):
+    r"""
+      Moves every entry to pageable host memory and copies it back synchronously when it is read.
+      This is the original behaviour of `Cross_Frame_Attention`.
+      """
+
+    placement = "cpu"
+
+    def _store(self, tensors):
+        return tuple(t.to("cpu") for t in tensors)
+
+    def _load(self, stored, device):
+        return tuple(t.to(device) for t in stored)
+
+
+class PinnedKVStore(KVStore):
+    r"""
+      Keeps entries in page-locked host memory. Reading an entry starts a non-blocking upload of
+      the entry stored after it on a side stream, so the copy for the next attention layer
+      overlaps with the attention computation of the current one. Without CUDA it behaves like
+      `HostKVStore`.
+      """
+
+    placement = "pinned"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pin = torch.cuda.is_available()
+        self.stream = torch.cuda.Stream() if self.pin else None
+        self.prefetched = {}
+
+    def _store(self, tensors):
+        if not self.pin:
+            return tuple(t.to("cpu") for t in tensors)
+        host = []
+        for t in tensors:
+            buffer = torch.empty(t.shape, dtype=t.dtype, device="cpu", pin_memory=True)
+            buffer.copy_(t, non_blocking=True)
+            host.append(buffer)
+        return tuple(host)
+
+    def _load(self, stored, device):
+        return tuple(t.to(device, non_blocking=self.pin) for t in stored)
+
+    def _fetch(self, key, device):
+        if not self.pin or device.type != "cuda":
+            return self._load(self.entries[key], device)
+
+        current = torch.cuda.current_stream(device)
+        if key in self.prefetched:
+            tensors, event = self.prefetched.pop(key)
+            current.wait_event(event)
+            for t in tensors:
+                t.record_stream(current)
+        else:
+            # the read order left the storage order (e.g. a timestep was skipped), drop stale uploads
+            self.prefetched.clear()
+            tensors = self._load(self.entries[key], device)
+        self._prefetch(self.next_key(key), device)
+        return tensors
+
+    def _prefetch(self, key, device):
+        if key in self.prefetched:
+            return
+        self.stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(self.stream):
+            tensors = self._load(self.entries[key], device)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.prefetched[key] = (tensors, event)
+
+    def clear(self):
+        super().clear()
+        self.prefetched = {}
+
+
+class DiskKVStore(KVStore):
+    r"""
+      Spills every entry to `.npy` files and reads them back through memory maps, so the anchor
+      cache costs neither accelerator nor host memory beyond the page cache.
+
+      Attributes:
+          directory (str): Folder holding the spilled tensors. A temporary folder is created
+                           when none is given and removed again on `clear`.
+      """
+
+    placement = "disk"
+
+    def __init__(self, directory=None, **kwargs):
+        super().__init__(**kwargs)
+        self.owns_directory = directory is None
+        self.directory = directory
+        self._count = 0
+
+    def _store(self, tensors):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="kv_store_")
+        os.makedirs(self.directory, exist_ok=True)
+        stored = []
+        for t in tensors:
+            t = t.to("cpu")
+            dtype = t.dtype
+            if dtype in (torch.bfloat16, FLOAT8):
+                # numpy has no such dtypes, the raw bits are stored instead
+                t = t.view(torch.int16 if t.element_size() == 2 else torch.uint8)
+            path = os.path.join(self.directory, f"{self._count:06d}.npy")
+            np.save(path, t.numpy())
+            self._count += 1
+            stored.append((path, dtype, t.numel() * t.element_size()))
+        return tuple(stored)
+
+    def _load(self, stored, device):
+        tensors = []
+        for path, dtype, _ in stored:
+            t = torch.from_numpy(np.load(path, mmap_mode="c"))
+            tensors.append(t.view(dtype).to(device))
+        return tuple(tensors)
+
+    def _entry_nbytes(self, stored):
+        return sum(size for _, _, size in stored)
+
+    def clear(self):
+        super().clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            if self.owns_directory:
+                shutil.rmtree(self.directory)
+                self.directory = None
+            else:
+                for name in os.listdir(self.directory):
+                    if name.endswith(".npy"):
+                        os.remove(os.path.join(self.directory, name))
+        self._count = 0
+
+
+KV_STORES = {
+    store.placement: store for store in (DeviceKVStore, HostKVStore, PinnedKVStore, DiskKVStore)
+}
+
+
+def get_kv_store(placement="cpu", **kwargs):
+    if placement not in KV_STORES:
+        raise ValueError(f"Unknown kv cache placement '{placement}', expected one of {sorted(KV_STORES)}")
+    return KV_STORES[placement](**kwargs)
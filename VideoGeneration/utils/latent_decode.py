@@ -0,0 +1,81 @@
+import os
+
+import torch
+
+from .tracing import NullTracer
+
+
+@torch.no_grad()
+def decode_latents(pipe, latents):
+    r"""
+      Decodes final latents into PIL images the way `StableDiffusionXLControlNetPipeline` does,
+      including the float32 upcast of VAEs that overflow in float16 and the watermark.
+      """
+    vae = pipe.vae
+    upcast = vae.config.force_upcast and pipe.unet.dtype == torch.float16
+    if upcast:
+        pipe.upcast_vae()
+    latents = latents.to(device=vae.device, dtype=next(iter(vae.post_quant_conv.parameters())).dtype)
+    image = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0]
+    if upcast:
+        vae.to(dtype=torch.float16)
+    if pipe.watermark is not None:
+        image = pipe.watermark.apply_watermark(image)
+    return pipe.image_processor.postprocess(image, output_type="pil")
+
+
+def latents_path(directory, idx):
+    return os.path.join(directory, f"{idx}.pt")
+
+
+def load_latents(directory, idx):
+    return torch.load(latents_path(directory, idx), map_location="cpu")
+
+
+class LatentDecoder:
+    r"""
+      Queue of the final latents of rendered frames, decoded by the VAE in batches of its own
+      size rather than one pipeline call at a time. Frames rendered one by one then share VAE
+      calls, and the decode cost is paid in a few large steps instead of a spike per frame.
+
+      With `latents_dir` every frame's latents are also saved there as "<idx>.pt" when they are
+      queued, so the frames can be decoded again later (e.g. with another VAE) without
+      denoising them again.
+
+      Attributes:
+          pipe (StableDiffusionXLControlNetPipeline): Pipeline whose VAE decodes the latents.
+          batch_size (int): Latents per VAE call.
+          latents_dir (str): Folder the latents are saved to, or None.
+          queue (list): (frame index, latents) pairs waiting to be decoded, in the order queued.
+      """
+
+    def __init__(self, pipe, batch_size=4, latents_dir=None, tracer=None):
+        self.pipe = pipe
+        self.batch_size = max(1, batch_size)
+        self.latents_dir = latents_dir
+        self.tracer = tracer if tracer is not None else NullTracer()
+        self.queue = []
+        if latents_dir is not None:
+            os.makedirs(latents_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __contains__(self, idx):
+        return any(queued == idx for queued, _ in self.queue)
+
+    def add(self, indices, latents):
+        for idx, frame_latents in zip(indices, latents.split(1)):
+            if self.latents_dir is not None:
+                torch.save(frame_latents.to("cpu", copy=True), latents_path(self.latents_dir, idx))
+            self.queue.append((idx, frame_latents))
+
+    def decode(self, flush=False):
+        r"""Decodes every full batch in the queue, and the rest too with `flush`. Returns {index: image}."""
+        frames = {}
+        while len(self.queue) >= self.batch_size or (flush and self.queue):
+            batch, self.queue = self.queue[:self.batch_size], self.queue[self.batch_size:]
+            with self.tracer.span("decode", frames=[idx for idx, _ in batch]):
+                images = decode_latents(self.pipe, torch.cat([latents for _, latents in batch]))
+            frames.update(zip((idx for idx, _ in batch), images))
+        return frames
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+import torch
+
+
+class PromptEmbeddingCache:
+    r"""
+      LRU cache of SDXL prompt embeddings keyed by the prompt text, so both text encoders run once
+      per distinct (prompt, negative prompt) pair instead of once per frame.
+
+      `get` returns the keyword arguments to pass to the pipeline in place of `prompt` and
+      `negative_prompt`, repeated to the requested batch size. With `offload_text_encoders` the
+      text encoders are moved to the CPU after each encoding and brought back only on a miss,
+      which frees their accelerator memory for the rest of the sequence.
+
+      Attributes:
+          pipe (StableDiffusionXLControlNetPipeline): Pipeline whose text encoders are used.
+          maxsize (int): Number of prompt pairs kept.
+          hits (int), misses (int): Lookup counters.
+      """
+
+    def __init__(self, pipe, maxsize=8, offload_text_encoders=False):
+        self.pipe = pipe
+        self.maxsize = maxsize
+        self.offload_text_encoders = offload_text_encoders
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def text_encoders(self):
+        return [encoder for encoder in (self.pipe.text_encoder, self.pipe.text_encoder_2) if encoder is not None]
+
+    def get(self, prompt, negative_prompt, do_classifier_free_guidance=True, batch_size=1):
+        key = (prompt, negative_prompt, do_classifier_free_guidance)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            self.entries[key] = self._encode(prompt, negative_prompt, do_classifier_free_guidance)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        prompt_embeds, negative_prompt_embeds, pooled, negative_pooled = self.entries[key]
+        embeds = {
+            "prompt_embeds": prompt_embeds.repeat(batch_size, 1, 1),
+            "pooled_prompt_embeds": pooled.repeat(batch_size, 1),
+        }
+        if do_classifier_free_guidance:
+            embeds["negative_prompt_embeds"] = negative_prompt_embeds.repeat(batch_size, 1, 1)
+            embeds["negative_pooled_prompt_embeds"] = negative_pooled.repeat(batch_size, 1)
+        return embeds
+
+    @torch.no_grad()
+    def _encode(self, prompt, negative_prompt, do_classifier_free_guidance):
+        device = self.pipe.device
+        if self.offload_text_encoders:
+            for encoder in self.text_encoders():
+                encoder.to(device)
+        embeds = self.pipe.encode_prompt(
+            prompt=prompt,
+            device=device,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            negative_prompt=negative_prompt,
+        )
+        if self.offload_text_encoders:
+            self.offload()
+        return embeds
+
+    def offload(self):
+        for encoder in self.text_encoders():
+            encoder.to("cpu")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,121 @@
+import importlib
+import json
+import os
+import tempfile
+
+import torch
+
+# pipeline components stored as models, in the order of `StableDiffusionXLControlNetPipeline`
+MODELS = ("vae", "text_encoder", "text_encoder_2", "unet")
+TOKENIZERS = ("tokenizer", "tokenizer_2")
+SNAPSHOT_VERSION = 1
+
+
+def _describe(model):
+    r"""Library, class and configuration needed to rebuild `model` without its weights."""
+    library = type(model).__module__.split(".")[0]
+    if library == "transformers":
+        config = model.config.to_dict()
+    else:
+        config = {key: value for key, value in model.config.items() if not key.startswith("_")}
+    return {"library": library, "class": type(model).__name__, "config": config}
+
+
+def _tokenizer_files(tokenizer):
+    with tempfile.TemporaryDirectory() as directory:
+        tokenizer.save_pretrained(directory)
+        files = {}
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name)) as file:
+                files[name] = file.read()
+    return {"class": type(tokenizer).__name__, "files": files}
+
+
+def save_snapshot(pipe, path, dtype=torch.float16):
+    r"""
+      Writes every model of an SDXL ControlNet pipeline, as assembled by `load_pipeline`, into a
+      single safetensors file: the weights in `dtype` under "<component>.<parameter>" names, and
+      the model classes, their configurations and the tokenizer files in the header metadata.
+      The ControlNets are stored in their order in `pipe.controlnet.nets` ("controlnet.0", ...).
+      """
+    from safetensors.torch import save_file
+
+    models = {name: getattr(pipe, name) for name in MODELS}
+    models.update({f"controlnet.{i}": net for i, net in enumerate(pipe.controlnet.nets)})
+    tensors = {}
+    for name, model in models.items():
+        for key, tensor in model.state_dict().items():
+            if tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            tensors[f"{name}.{key}"] = tensor.detach().to("cpu").contiguous()
+
+    description = {
+        "version": SNAPSHOT_VERSION,
+        "dtype": str(dtype).replace("torch.", ""),
+        "models": {name: _describe(model) for name, model in models.items()},
+        "tokenizers": {name: _tokenizer_files(getattr(pipe, name)) for name in TOKENIZERS},
+        "pipeline": {"force_zeros_for_empty_prompt": pipe.config.get("force_zeros_for_empty_prompt", True)},
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    save_file(tensors, path + ".tmp", metadata={"snapshot": json.dumps(description)})
+    os.replace(path + ".tmp", path)
+
+
+def _empty_model(description):
+    r"""Builds a model with its parameters on the meta device, so no time is spent initializing them."""
+    from accelerate import init_empty_weights
+
+    model_class = getattr(importlib.import_module(description["library"]), description["class"])
+    with init_empty_weights():
+        if description["library"] == "transformers":
+            return model_class(model_class.config_class.from_dict(description["config"]))
+        return model_class.from_config(description["config"])
+
+
+def _load_tokenizer(description):
+    tokenizer_class = getattr(importlib.import_module("transformers"), description["class"])
+    with tempfile.TemporaryDirectory() as directory:
+        for name, content in description["files"].items():
+            with open(os.path.join(directory, name), "w") as file:
+                file.write(content)
+        return tokenizer_class.from_pretrained(directory)
+
+
+def load_snapshot(path, device="cpu", dtype=torch.float16):
+    r"""
+      Rebuilds the components written by `save_snapshot`. The file is memory-mapped and every
+      tensor is copied once, straight to `device` in `dtype`, into models built without
+      initializing their weights. Only the model and tokenizer classes named in the snapshot are
+      imported.
+
+      Returns the keyword arguments of `StableDiffusionXLControlNetPipeline` except the scheduler,
+      with `controlnet` as a list, and the pipeline options stored with them.
+      """
+    from accelerate.utils import set_module_tensor_to_device
+    from safetensors import safe_open
+
+    with safe_open(path, framework="pt", device=str(device)) as file:
+        description = json.loads(file.metadata()["snapshot"])
+        if description["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is a version {description['version']} snapshot, "
+                             f"expected version {SNAPSHOT_VERSION}")
+        models = {name: _empty_model(model) for name, model in description["models"].items()}
+        for key in file.keys():
+            # "controlnet.0.conv_in.weight" belongs to "controlnet.0", "unet.conv_in.weight" to "unet"
+            name = next(model for model in models if key.startswith(model + "."))
+            tensor_name = key[len(name) + 1:]
+            tensor = file.get_tensor(key)
+            set_module_tensor_to_device(models[name], tensor_name, device, value=tensor,
+                                        dtype=dtype if tensor.is_floating_point() else None)
+
+    for name, model in models.items():
+        missing = [key for key, parameter in model.named_parameters() if parameter.device.type == "meta"]
+        if missing:
+            raise ValueError(f"{path} has no weights for {name}: {', '.join(missing[:5])}")
+        model.eval()
+
+    components = {name: models[name] for name in MODELS}
+    components["controlnet"] = [models[name] for name in sorted(
+        (name for name in models if name.startswith("controlnet.")), key=lambda name: int(name.split(".")[1]))]
+    components.update({name: _load_tokenizer(tokenizer) for name, tokenizer in description["tokenizers"].items()})
+    return components, description["pipeline"]
@@ -0,0 +1,107 @@
+import json
+import os
+import tempfile
+
+import torch
+
+
+def tiny_tokenizer():
+    r"""Byte-level CLIP tokenizer without merges, so no vocabulary has to be downloaded."""
+    from transformers import CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    chars = list(bytes_to_unicode().values())
+    vocab = chars + [c + "</w>" for c in chars] + ["<|startoftext|>", "<|endoftext|>"]
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "vocab.json"), "w") as file:
+            json.dump({token: i for i, token in enumerate(vocab)}, file)
+        with open(os.path.join(directory, "merges.txt"), "w") as file:
+            file.write("#version: 0.2\n")
+        return CLIPTokenizer(os.path.join(directory, "vocab.json"), os.path.join(directory, "merges.txt"),
+                             model_max_length=77)
+
+
+def tiny_components(seed=0):
+    r"""
+      Randomly initialized models with the layout of SDXL and its ControlNets, small enough to
+      run a whole sequence on the CPU: three UNet levels with cross-attention in the lower two,
+      text-time conditioning from two text encoders, and a VAE and ControlNet conditioning
+      embedding that both downsample by 8.
+
+      The weights only depend on `seed`, so every process that builds the components gets the
+      same models. Returns the keyword arguments of `StableDiffusionXLControlNetPipeline`
+      except the scheduler, with `controlnet` as a list [depth, canny].
+      """
+    from diffusers import AutoencoderKL, ControlNetModel
+    from diffusers.models import UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection
+
+    generator_state = torch.random.get_rng_state()
+    torch.manual_seed(seed)
+    try:
+        tokenizer = tiny_tokenizer()
+        vocab_size = len(tokenizer.encoder)
+        text_config = CLIPTextConfig(
+            hidden_size=32, intermediate_size=37, num_attention_heads=4, num_hidden_layers=2,
+            vocab_size=vocab_size, projection_dim=32, hidden_act="gelu", max_position_embeddings=77,
+            bos_token_id=vocab_size - 2, eos_token_id=vocab_size - 1, pad_token_id=vocab_size - 1,
+        )
+        text_encoder = CLIPTextModel(text_config)
+        text_encoder_2 = CLIPTextModelWithProjection(text_config)
+
+        unet_config = dict(
+            block_out_channels=(32, 64, 64),
+            layers_per_block=1,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D", "CrossAttnDownBlock2D"),
+            attention_head_dim=(2, 4, 4),
+            transformer_layers_per_block=(1, 1, 2),
+            use_linear_projection=True,
+            addition_embed_type="text_time",
+            addition_time_embed_dim=8,
+            # pooled text embeddings (32) + 6 micro-conditioning values * 8
+            projection_class_embeddings_input_dim=80,
+            cross_attention_dim=64,
+            in_channels=4,
+        )
+        unet = UNet2DConditionModel(
+            out_channels=4,
+            up_block_types=("CrossAttnUpBlock2D", "CrossAttnUpBlock2D", "UpBlock2D"),
+            **unet_config,
+        )
+        controlnets = [
+            ControlNetModel(conditioning_embedding_out_channels=(8, 8, 16, 16), **unet_config)
+            for _ in range(2)
+        ]
+        for controlnet in controlnets:
+            # diffusers zero-initializes the last layer of the condition embedding and the
+            # convolutions that emit the residuals, which would make the residuals zero whatever
+            # the condition images; the embedding is also given a variance-preserving init, so the
+            # conditions still matter after its few layers
+            embedding = controlnet.controlnet_cond_embedding
+            for conv in (embedding.conv_in, *embedding.blocks, embedding.conv_out):
+                torch.nn.init.kaiming_normal_(conv.weight, nonlinearity="relu")
+                torch.nn.init.zeros_(conv.bias)
+            for conv in (*controlnet.controlnet_down_blocks, controlnet.controlnet_mid_block):
+                torch.nn.init.normal_(conv.weight, std=0.05)
+                torch.nn.init.zeros_(conv.bias)
+        vae = AutoencoderKL(
+            block_out_channels=[8, 8, 16, 16],
+            norm_num_groups=8,
+            in_channels=3,
+            out_channels=3,
+            down_block_types=["DownEncoderBlock2D"] * 4,
+            up_block_types=["UpDecoderBlock2D"] * 4,
+            latent_channels=4,
+        )
+    finally:
+        torch.random.set_rng_state(generator_state)
+
+    return {
+        "vae": vae,
+        "text_encoder": text_encoder,
+        "text_encoder_2": text_encoder_2,
+        "tokenizer": tokenizer,
+        "tokenizer_2": tokenizer,
+        "unet": unet,
+        "controlnet": controlnets,
+    }
@@ -0,0 +1,192 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+import torch
+
+
+class NullTracer:
+    r"""Tracer used when tracing is disabled: spans cost a no-op context manager."""
+
+    enabled = False
+
+    def span(self, name, category="stage", **args):
+        return contextlib.nullcontext()
+
+    def begin(self, name, category="stage", **args):
+        pass
+
+    def end(self):
+        pass
+
+
+class Tracer:
+    r"""
+      Records the wall time and the memory of nested stages of a run, and writes them as a Chrome
+      trace (chrome://tracing or ui.perfetto.dev) together with a summary table.
+
+      Stages are opened with the `span` context manager, or with `begin`/`end` pairs from module
+      hooks (see `trace_pipeline`). Each thread has its own stack of open stages, so the output
+      threads appear as separate tracks. Every stage records the peak memory allocated on the
+      device while it was open, or the resident memory of the process at its end on the CPU.
+
+      With `synchronize` the device is synchronized when a stage opens and closes, so GPU time is
+      attributed to the stage that launched it at the price of some overlap.
+
+      Attributes:
+          device (torch.device): Device whose memory is tracked.
+          events (list): Finished stages as Chrome trace events.
+      """
+
+    enabled = True
+
+    def __init__(self, device="cuda", synchronize=True):
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda" and torch.cuda.is_available()
+        self.synchronize = synchronize
+        self.events = []
+        self.threads = {}
+        self.origin = time.perf_counter()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.process = None
+        if not self.cuda:
+            import psutil
+            self.process = psutil.Process()
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def _now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def _tracks_device(self):
+        # the peak statistics are global to the device, only the main thread (the one that runs the
+        # models) resets them
+        return self.cuda and threading.current_thread() is threading.main_thread()
+
+    def begin(self, name, category="stage", **args):
+        stack = self._stack()
+        if self._tracks_device():
+            if self.synchronize:
+                torch.cuda.synchronize(self.device)
+            peak = torch.cuda.max_memory_allocated(self.device)
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        stack.append({"name": name, "category": category, "args": args, "start": self._now(), "peak": 0})
+
+    def end(self):
+        stack = self._stack()
+        span = stack.pop()
+        memory = {}
+        if self._tracks_device():
+            if self.synchronize:
+                torch.cuda.synchronize(self.device)
+            peak = max(span["peak"], torch.cuda.max_memory_allocated(self.device))
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            memory = {"peak_allocated_MB": round(peak / 2 ** 20, 1)}
+        elif not self.cuda:
+            memory = {"rss_MB": round(self.process.memory_info().rss / 2 ** 20, 1)}
+        end = self._now()
+        event = {
+            "name": span["name"],
+            "cat": span["category"],
+            "ph": "X",
+            "ts": span["start"],
+            "dur": end - span["start"],
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": dict(span["args"], **memory),
+        }
+        with self.lock:
+            self.events.append(event)
+            self.threads[event["tid"]] = threading.current_thread().name
+
+    @contextlib.contextmanager
+    def span(self, name, category="stage", **args):
+        self.begin(name, category, **args)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                    for tid, name in threads.items()]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file)
+
+    def summary(self):
+        stats = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            entry = stats.setdefault((event["cat"], event["name"]), {"calls": 0, "total": 0.0, "max": 0.0, "memory": 0.0})
+            entry["calls"] += 1
+            entry["total"] += event["dur"] / 1000
+            entry["max"] = max(entry["max"], event["dur"] / 1000)
+            entry["memory"] = max([entry["memory"]] + [v for k, v in event["args"].items() if k.endswith("_MB")])
+        return stats
+
+    def format_summary(self):
+        memory = "peak MB" if self.cuda else "RSS MB"
+        lines = [f"{'stage':<28}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'max ms':>10}{memory:>10}"]
+        for (category, name), entry in sorted(self.summary().items(), key=lambda item: -item[1]["total"]):
+            lines.append(f"{category + '/' + name:<28}{entry['calls']:>8}{entry['total']:>12.1f}"
+                         f"{entry['total'] / entry['calls']:>10.2f}{entry['max']:>10.2f}{entry['memory']:>10.1f}")
+        return "\n".join(lines)
+
+
+def trace_module(tracer, module, name, category="model"):
+    r"""Traces every forward call of `module` as a stage."""
+    def start(module, args, kwargs):
+        tracer.begin(name, category)
+
+    def stop(module, args, output):
+        tracer.end()
+
+    return [module.register_forward_pre_hook(start, with_kwargs=True), module.register_forward_hook(stop)]
+
+
+def trace_pipeline(tracer, pipe):
+    r"""
+      Traces the models of an SDXL ControlNet pipeline: both text encoders, the ControlNets, the
+      UNet and the VAE decoder. Each denoising step is a "step" stage around the ControlNet and
+      UNet calls, with the timestep as argument.
+      """
+    handles = []
+    for encoder_name in ("text_encoder", "text_encoder_2"):
+        encoder = getattr(pipe, encoder_name, None)
+        if encoder is not None:
+            handles += trace_module(tracer, encoder, encoder_name)
+
+    def start_step(module, args, kwargs):
+        timestep = args[1] if len(args) > 1 else kwargs["timestep"]
+        if torch.is_tensor(timestep):
+            timestep = timestep.flatten()[0]
+        tracer.begin("step", "step", timestep=int(round(float(timestep))))
+
+    def stop_step(module, args, output):
+        tracer.end()
+
+    # the pipeline runs the ControlNets first, the step opens with them and closes after the UNet
+    handles.append(pipe.controlnet.register_forward_pre_hook(start_step, with_kwargs=True))
+    handles += trace_module(tracer, pipe.controlnet, "controlnet")
+    handles += trace_module(tracer, pipe.unet, "unet")
+    handles.append(pipe.unet.register_forward_hook(stop_step))
+    handles += trace_module(tracer, pipe.vae.decoder, "vae_decode")
+    return handles
+
+
+def get_tracer(enabled=False, device="cuda", synchronize=True):
+    return Tracer(device, synchronize) if enabled else NullTracer()
@@ -1,13 +1,14 @@
 import os
+import random
 import numpy as np
 from PIL import Image
 
+from .frame_sequence import FrameSequence, check_condition_sequences, invert_depth, last_channel
+from .kv_store import get_kv_store
+
 
 def get_freestyle_images(path):
-    img_name = os.listdir(path)
-    img_name.sort()
-    img = [Image.open(path + "/" + i).split()[-1] for i in img_name if '.png' in i]
-    return img
+    return FrameSequence.from_folder(path, last_channel)
 
 
 def get_images(path):
@@ -25,11 +26,14 @@ def get_images_nothing(path):
 
 
 def get_depth_images(path):
-    img_name = os.listdir(path)
-    img_name.sort()
-    img = [Image.open(path + "/" + i).convert("L") for i in img_name if '.png' in i]
-    img = [Image.fromarray(255 - np.array(dep), mode='L') for dep in img]
-    return img
+    return FrameSequence.from_folder(path, invert_depth)
+
+
+def get_condition_images(path):
+    canny_images = get_freestyle_images(f"{path}/freestyle/")
+    depth = get_depth_images(f"{path}/depth/")
+    check_condition_sequences(depth, canny_images)
+    return depth, canny_images
 
 
 def get_canny(images):
@@ -43,31 +47,40 @@ def get_canny(images):
     return canny_images
 
 
-def register_attention_control(model, controller):
+def seed_everything(seed):
+    # same seeding as pytorch_lightning.seed_everything, without importing lightning at startup
+    import torch
+    os.environ["PL_GLOBAL_SEED"] = str(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    return seed
+
+
+def caches_layer(name, blocks=None):
+    # blocks are prefixes of the processor names, e.g. "down_blocks", "mid_block" or "up_blocks.0"
+    return blocks is None or any(name == block or name.startswith(block + ".") for block in blocks)
+
+
+def register_attention_control(model, processor, kv_store=None, blocks=None, timesteps=None):
+    r"""
+      Installs `processor` on every attention layer of the UNet, once, and returns the
+      `AttentionController` they share. Only the self-attention layers under `blocks` cache the
+      initial frame, within the `timesteps` range.
+      """
+    from .Cross_Frame_Attention import AttentionController
+    if kv_store is None:
+        kv_store = get_kv_store("cpu")
+    controller = AttentionController(kv_store)
+    controller.attach(model.unet)
     attn_procs = {}
-    cross_att_count = 0
     for name in model.unet.attn_processors.keys():
-        if name.endswith("attn1.processor"):
-            attn_procs[name] = controller(forever_keep=False)
+        if name.endswith("attn1.processor") and caches_layer(name, blocks):
+            attn_procs[name] = processor(forever_keep=False, controller=controller, name=name,
+                                         timesteps=timesteps)
         else:
-            attn_procs[name] = controller(forever_keep=True)
-
+            attn_procs[name] = processor(forever_keep=True, controller=controller)
 
     model.unet.set_attn_processor(attn_procs)
-
-
-def move_index_to_zero(model):
-    attn_dict = model.attn_processors
-    key = list(attn_dict.keys())
-    for k in key:
-        attn_dict[k].index = 0
-    model.set_attn_processor(attn_dict)
-
-
-def set_kv_to_none(model):
-    attn_dict = model.attn_processors
-    key = list(attn_dict.keys())
-    for k in key:
-        attn_dict[k].k = []
-        attn_dict[k].v = []
-    model.set_attn_processor(attn_dict)
+    return controller
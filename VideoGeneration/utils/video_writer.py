@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class StreamingVideoWriter:
+    r"""
+      Encodes frames into a video file as soon as they are produced, so memory stays constant
+      however long the sequence is and a partial video exists while the run is in progress.
+
+      Used as a context manager the writer is closed on any exit, including an interruption, which
+      lets ffmpeg finalize the container so the frames written so far stay playable.
+
+      Attributes:
+          path (str): Output file. Lossy videos are H.264 (".mp4"), lossless ones FFV1 in RGB
+                      (usually ".mkv"), meant as an intermediate to transcode from later.
+          frames (int): Number of frames written so far.
+      """
+
+    def __init__(self, path, fps, lossless=False):
+        # imageio (and its ffmpeg plugin) is only imported when a video is written
+        import imageio
+        self.path = path
+        self.frames = 0
+        if lossless:
+            self.writer = imageio.get_writer(path, fps=fps, codec="ffv1", pixelformat="bgr0",
+                                             macro_block_size=1)
+        else:
+            self.writer = imageio.get_writer(path, fps=fps)
+
+    def append(self, image):
+        self.writer.append_data(np.asarray(image.convert("RGB") if hasattr(image, "convert") else image))
+        self.frames += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()